@@ -0,0 +1,260 @@
+'''
+Compress many EIGER master files, in parallel.
+
+Usage:
+    python -m chx_compress.io.eiger.batch DIRECTORY_OR_GLOB [-o OUTDIR]
+        [-j WORKERS] [--overwrite] [--bnl-version 3] [--codec zlib]
+
+Every master file is one job, run by compress_file in a pool of
+processes. The jobs are ordered largest first (by the bytes of frames
+read, from the dataset shapes), so a large file started last does not
+keep the node busy alone at the end. Outputs that are already complete
+are skipped, and the interrupted ones are resumed from their last
+checkpoint, so an interrupted batch can be run again.
+
+The EIGER datasets are decompressed by the HDF5 filter plugins, which
+can use several threads each. The workers are split between the
+processes and the threads of every process, so that processes times
+threads stays within the workers asked for.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import glob
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+from .compress_file import _select_frames, compress_file
+from .eiger import get_valid_keys
+from ..multifile.codec import ENCODINGS
+from ..multifile.multifile import (BNL_INDEX_MAGIC, BNL_INDEX_TRAILER,
+                                   MultifileBNL)
+
+logger = logging.getLogger(__name__)
+
+# read by the HDF5 filter plugins (bitshuffle/LZ4, blosc) for their
+# number of threads
+DECODER_THREAD_VARS = ['OMP_NUM_THREADS', 'BLOSC_NTHREADS']
+
+
+def find_masters(source, pattern="*_master.h5"):
+    ''' Return the sorted master files of a directory (matching pattern),
+        or matching a glob.
+    '''
+    if os.path.isdir(source):
+        source = os.path.join(source, pattern)
+    return sorted(glob.glob(source))
+
+
+def output_name(master, outdir=None):
+    ''' The output file of a master file, e.g. scan_master.h5 gives
+        scan.bin, in outdir or next to the master file.
+    '''
+    name = os.path.basename(master)
+    if name.endswith("_master.h5"):
+        name = name[:-len("_master.h5")] + ".bin"
+    else:
+        name = os.path.splitext(name)[0] + ".bin"
+    return os.path.join(outdir or os.path.dirname(master), name)
+
+
+def estimate_job(master, version="v1.3.0", beg=0, end=None, stride=1,
+                 keys=None):
+    '''
+        Return (nframes, cost) of compressing a master file, cost being
+        the number of bytes of the frames read.
+
+        beg, end, stride and keys select the frames, as for
+        compress_file.
+    '''
+    import h5py
+
+    dset_keys, dims_per_key = get_valid_keys(master, version=version)
+    with h5py.File(master, "r") as f:
+        nimgs = [f[dset_key].shape[0] for dset_key in dset_keys]
+        itemsize = f[dset_keys[0]].dtype.itemsize
+    slabs, source_frames = _select_frames(dset_keys, nimgs, beg=beg,
+                                          end=end, stride=stride, keys=keys)
+    nframes = len(source_frames)
+    return nframes, nframes*int(np.prod(dims_per_key[1:]))*itemsize
+
+
+def is_complete(outfile, nframes):
+    ''' Check if outfile is a complete output of nframes frames.
+
+        compress_file only ever leaves complete files at outfile (it
+        renames them there when they are done). Files with an index
+        footer are checked by the number of frames in it and by their
+        size, the others only by their size (at least a 4 byte dlen per
+        frame).
+    '''
+    try:
+        size = os.path.getsize(outfile)
+    except OSError:
+        return False
+    if size < MultifileBNL.HEADER_SIZE + 4*nframes:
+        return False
+    with open(outfile, "rb") as f:
+        f.seek(max(size - BNL_INDEX_TRAILER, 0))
+        trailer = f.read(BNL_INDEX_TRAILER)
+    if trailer[:8] == BNL_INDEX_MAGIC:
+        return (struct.unpack('<Q', trailer[8:])[0] == nframes and size >=
+                MultifileBNL.HEADER_SIZE + 12*nframes + BNL_INDEX_TRAILER)
+    return True
+
+
+def _init_worker(threads):
+    for var in DECODER_THREAD_VARS:
+        os.environ[var] = str(threads)
+
+
+def _run_job(master, outfile, kwargs):
+    ''' Compress one file, return (seconds, output bytes). This is run by
+        the worker processes.
+    '''
+    t0 = time.time()
+    compress_file(master, outfile, **kwargs)
+    return time.time() - t0, os.path.getsize(outfile)
+
+
+def compress_batch(source, outdir=None, workers=None, pattern="*_master.h5",
+                   overwrite=False, version="v1.3.0", **kwargs):
+    '''
+        Compress all the master files of a directory or a glob.
+
+        Parameters
+        ----------
+        source : str
+            a directory, or a glob of master files
+        outdir : str, optional
+            where the outputs go, next to the master files by default
+            (see output_name)
+        workers : int, optional
+            number of cores to use, all of them by default. The batch
+            runs min(workers, number of jobs) processes, and the HDF5
+            decoders of every process use workers // processes threads.
+        pattern : str, optional
+            the master files of a directory source
+        overwrite : bool, optional
+            compress again the files whose output is already complete
+        version : str, optional
+            the version string of the hdf5 files (see compress_file)
+        **kwargs : passed to compress_file (e.g. bnl_version, codec, or
+            the selection beg, end, stride and keys). The jobs are run
+            with resume=True unless told otherwise.
+
+        Returns
+        -------
+        report : dict
+            'done', 'skipped' and 'failed' (lists of master files),
+            'nframes' and 'bytes_read' of the jobs done, 'bytes_written',
+            'seconds' (wall time), 'frames_per_second' and
+            'bytes_per_second' (aggregate read throughput)
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+    kwargs.setdefault('resume', True)
+    selection = {key: kwargs[key] for key in ('beg', 'end', 'stride', 'keys')
+                 if key in kwargs}
+
+    jobs, skipped, failed = list(), list(), list()
+    for master in find_masters(source, pattern=pattern):
+        outfile = output_name(master, outdir)
+        try:
+            nframes, cost = estimate_job(master, version=version,
+                                         **selection)
+        except Exception as exc:
+            logger.error("Can't read %s: %s", master, exc)
+            failed.append(master)
+            continue
+        if not overwrite and is_complete(outfile, nframes):
+            logger.info("Skipping %s, %s is complete", master, outfile)
+            skipped.append(master)
+            continue
+        jobs.append((cost, nframes, master, outfile))
+    # largest first
+    jobs.sort(key=lambda job: job[0], reverse=True)
+
+    report = dict(done=list(), skipped=skipped, failed=failed, nframes=0,
+                  bytes_read=0, bytes_written=0)
+    t0 = time.time()
+    if jobs:
+        nprocs = min(workers, len(jobs))
+        threads = max(1, workers // nprocs)
+        logger.info("Compressing %s files with %s processes of %s decoder "
+                    "threads", len(jobs), nprocs, threads)
+        kwargs['version'] = version
+        with ProcessPoolExecutor(nprocs, initializer=_init_worker,
+                                 initargs=(threads,)) as pool:
+            results = [pool.submit(_run_job, master, outfile, kwargs)
+                       for cost, nframes, master, outfile in jobs]
+            for (cost, nframes, master, outfile), result in zip(jobs,
+                                                                results):
+                try:
+                    seconds, nbytes = result.result()
+                except Exception as exc:
+                    logger.error("Compressing %s failed: %s", master, exc)
+                    failed.append(master)
+                    continue
+                logger.info("%s: %s frames in %.1f s, %.1f MB/s", master,
+                            nframes, seconds, cost/max(seconds, 1e-9)/1e6)
+                report['done'].append(master)
+                report['nframes'] += nframes
+                report['bytes_read'] += cost
+                report['bytes_written'] += nbytes
+    report['seconds'] = seconds = max(time.time() - t0, 1e-9)
+    report['frames_per_second'] = report['nframes']/seconds
+    report['bytes_per_second'] = report['bytes_read']/seconds
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compress the EIGER master files of a directory or a "
+                    "glob into BNL multifiles.")
+    parser.add_argument("source", help="a directory or a glob of master "
+                        "files")
+    parser.add_argument("-o", "--outdir", default=None,
+                        help="output directory, next to the master files "
+                        "by default")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+                        help="number of cores, all of them by default")
+    parser.add_argument("--pattern", default="*_master.h5",
+                        help="master files of a directory source")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="compress again complete outputs")
+    parser.add_argument("--bnl-version", type=int, default=2,
+                        choices=[2, 3])
+    parser.add_argument("--encoding", default='varint',
+                        choices=list(ENCODINGS))
+    parser.add_argument("--codec", default=None, choices=['zlib', 'lzma'])
+    args = parser.parse_args(argv)
+    if args.codec is not None and args.bnl_version != 3:
+        parser.error("--codec needs --bnl-version 3")
+    if args.encoding != 'varint' and args.bnl_version != 3:
+        parser.error("--encoding {} needs --bnl-version 3"
+                     .format(args.encoding))
+
+    logging.basicConfig(level=logging.INFO)
+    report = compress_batch(args.source, outdir=args.outdir,
+                            workers=args.workers, pattern=args.pattern,
+                            overwrite=args.overwrite,
+                            bnl_version=args.bnl_version,
+                            encoding=args.encoding, codec=args.codec)
+    print("{} files compressed, {} skipped, {} failed".format(
+        len(report['done']), len(report['skipped']), len(report['failed'])))
+    print("{} frames in {:.1f} s: {:.1f} frames/s, {:.1f} MB/s read, "
+          "{:.1f} MB written".format(
+              report['nframes'], report['seconds'],
+              report['frames_per_second'], report['bytes_per_second']/1e6,
+              report['bytes_written']/1e6))
+    return 1 if report['failed'] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
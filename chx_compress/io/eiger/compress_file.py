@@ -1,13 +1,293 @@
-import h5py
+import json
+import logging
+import os
+import time
+
 import numpy as np
-from tqdm import tqdm
 
-import struct
+from .eiger import (get_count_cutoff, get_header_binary, get_nframes,
+                    get_pixel_mask, get_valid_keys)
+from ..multifile.compress import (check_bnl_version, encode_block,
+                                  mask_to_index, pixel_layout, renumber,
+                                  value_width)
+from ..multifile.writer import MultifileBNLWriter
+
+logger = logging.getLogger(__name__)
+
+
+def _select_frames(dset_keys, nimgs, beg=0, end=None, stride=1,
+                   keys=None):
+    '''
+        Translate a selection of frames into hyperslabs of the datasets.
+
+        The frames are numbered over all the datasets, in key order.
+
+        Parameters
+        ----------
+        dset_keys : list of str
+            the dataset keys (see get_valid_keys)
+        nimgs : list of int
+            the number of frames of every dataset
+        beg, end, stride : int, optional
+            the frames range(beg, end, stride), end defaults to all
+        keys : list of str, optional
+            only the frames of these datasets, by key or by name (e.g.
+            'data_000002')
+
+        Returns
+        -------
+        slabs : list of (dataset key, first, last, stride)
+            the frames range(first, last, stride) of the dataset
+        source_frames : np.ndarray
+            the frame number of every selected frame
+    '''
+    if beg < 0 or stride < 1:
+        raise ValueError("Error, beg must be >= 0 and stride >= 1, got : "
+                         "{}, {}".format(beg, stride))
+    names = [dset_key.split("/")[-1] for dset_key in dset_keys]
+    if keys is not None:
+        keys = set(key.split("/")[-1] for key in keys)
+        if not keys.issubset(names):
+            raise ValueError("Error, no dataset {}"
+                             .format(sorted(keys.difference(names))))
+    starts = np.concatenate([[0], np.cumsum(nimgs)]).astype(np.int64)
+    if end is None:
+        end = starts[-1]
+    slabs, source_frames = list(), list()
+    for i, dset_key in enumerate(dset_keys):
+        if keys is not None and names[i] not in keys:
+            continue
+        lo, hi = max(beg, starts[i]), min(end, starts[i+1])
+        # the first frame of the dataset in the selection
+        lo += (beg - lo) % stride
+        if lo >= hi:
+            continue
+        slabs.append((dset_key, int(lo - starts[i]), int(hi - starts[i]),
+                      stride))
+        source_frames.append(np.arange(lo, hi, stride))
+    if not source_frames:
+        return slabs, np.zeros(0, dtype=np.int64)
+    return slabs, np.concatenate(source_frames)
+
+
+def _read_blocks(f, slabs, block, verbose=False, start=0):
+    ''' Read the frames of the hyperslabs (see _select_frames) into
+        block, yield the filled part of block each time.
+
+        start : the number of frames (over all hyperslabs) to skip
+    '''
+    from tqdm import tqdm
+
+    block_size = block.shape[0]
+    for dset_key, first, last, stride in tqdm(slabs):
+        if verbose:
+            print("reading dataset {}".format(dset_key))
+        dset = f[dset_key]
+        nimgs = len(range(first, last, stride))
+        if start >= nimgs:
+            start -= nimgs
+            continue
+        skip, start = start, 0
+        for j in range(skip, nimgs, block_size):
+            nread = min(block_size, nimgs - j)
+            j0 = first + j*stride
+            # this is an important trick to ensure the reading is blazingly
+            # fast. Doing this incorrectly can result in a significant
+            # reduction in performance! At least a factor of 10!
+            # With a stride, only the selected frames are read (one
+            # hyperslab), not the frames in between.
+            dset.read_direct(block,
+                             np.s_[j0:j0 + (nread - 1)*stride + 1:stride],
+                             np.s_[:nread])
+            yield block[:nread]
+
+
+def _open_swmr(filename):
+    ''' Open an hdf5 file for reading while it may still be written.'''
+    import h5py
+
+    try:
+        return h5py.File(filename, "r", libver="latest", swmr=True)
+    except ValueError:
+        # not a SWMR capable file
+        return h5py.File(filename, "r")
+
+
+class _LiveDatasets(object):
+    '''
+        The data_ datasets of a master file that is still being written.
+
+        Every poll opens the master again to find the new data_ keys, and
+        refreshes the first axis of the datasets found before. Datasets
+        behind external links are opened in their own file, in SWMR mode,
+        and kept open: their shape is not refreshed through the link.
+        A key whose file does not exist yet, or can't be opened yet, is
+        looked for again at the next poll.
+
+        keys and sizes (the frames of every dataset) are updated in place.
+    '''
+    def __init__(self, filename, version="v1.3.0"):
+        self.filename = filename
+        # as in get_valid_keys
+        if version >= "v1.3.0":
+            self._root, self._first = "/entry/data", 1
+        else:
+            self._root, self._first = "/entry", 0
+        self._master = None
+        self._files = list()
+        self.dsets = list()
+        self.keys = list()
+        self.sizes = list()
+
+    def poll(self):
+        ''' Look for new frames, return the sizes.'''
+        import h5py
+
+        try:
+            master = _open_swmr(self.filename)
+        except OSError:
+            # being written, try again at the next poll
+            return self.sizes
+        if self._master is not None:
+            self._master.close()
+        self._master = master
+        for i, (fdata, dset) in enumerate(zip(self._files, self.dsets)):
+            if fdata is None:
+                self.dsets[i] = master[self.keys[i]]
+            else:
+                dset.refresh()
+        while True:
+            key = "{}/data_{:06d}".format(self._root,
+                                          len(self.keys) + self._first)
+            link = master.get(key, getlink=True)
+            if link is None:
+                break
+            fdata = None
+            if isinstance(link, h5py.ExternalLink):
+                datafile = os.path.join(os.path.dirname(self.filename),
+                                        link.filename)
+                if not os.path.exists(datafile):
+                    break
+                try:
+                    fdata = _open_swmr(datafile)
+                    dset = fdata[link.path]
+                except (OSError, KeyError):
+                    if fdata is not None:
+                        fdata.close()
+                    break
+            else:
+                dset = master[key]
+            logger.info("Following %s", key)
+            self._files.append(fdata)
+            self.dsets.append(dset)
+            self.keys.append(key)
+        self.sizes[:] = [dset.shape[0] for dset in self.dsets]
+        return self.sizes
+
+    def wait(self, timeout=60., poll_interval=1.):
+        ''' Poll until the first dataset is found, return False after
+            timeout seconds without it.
+        '''
+        t0 = time.time()
+        while not self.poll():
+            if time.time() - t0 > timeout:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def close(self):
+        for fdata in self._files:
+            if fdata is not None:
+                fdata.close()
+        if self._master is not None:
+            self._master.close()
+        self._files, self.dsets, self._master = list(), list(), None
+
+
+def _follow_blocks(live, block, start=0, nframes=None, timeout=60.,
+                   poll_interval=1., on_wait=None):
+    ''' Read the frames of growing datasets into block as they appear,
+        yield the filled part of block each time.
+
+        live : the _LiveDatasets
+        start : the number of frames (over all datasets) to skip
+        nframes : stop once this many frames (over all datasets) are read
+        timeout : stop when no new frame appeared for this many seconds
+        on_wait : called with no arguments when the frames that appeared
+            are all read, before waiting for more
+
+        A dataset is considered complete once the next one exists.
+    '''
+    block_size = block.shape[0]
+    key, offset, done = 0, 0, 0
+    last, pending = time.time(), False
+    while nframes is None or done < nframes:
+        sizes = live.poll()
+        new = False
+        while key < len(sizes) and (nframes is None or done < nframes):
+            if offset >= sizes[key]:
+                if key + 1 == len(sizes):
+                    break
+                key, offset = key + 1, 0
+                continue
+            nread = sizes[key] - offset
+            if nframes is not None:
+                nread = min(nread, nframes - done)
+            if done < start:
+                # skipped, not read
+                nread = min(nread, start - done)
+            else:
+                nread = min(nread, block_size)
+                live.dsets[key].read_direct(block,
+                                            np.s_[offset:offset+nread],
+                                            np.s_[:nread])
+                yield block[:nread]
+                new = pending = True
+            offset += nread
+            done += nread
+        if new:
+            last = time.time()
+            continue
+        if pending and on_wait is not None:
+            on_wait()
+        pending = False
+        if nframes is not None and done >= nframes:
+            break
+        if time.time() - last > timeout:
+            logger.warning("No new frames for %s s, stopping after %s "
+                           "frames", timeout, done)
+            break
+        time.sleep(poll_interval)
+
+
+def _write_checkpoint(checkpoint, state):
+    ''' Replace the checkpoint file by state, atomically.'''
+    with open(checkpoint + ".tmp", "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+
+def _source_frame(dset_keys, nimgs, nframes):
+    ''' Return (dataset key, frame in the dataset) of global frame nframes.
+    '''
+    for dset_key, n in zip(dset_keys, nimgs):
+        if nframes < n:
+            return dset_key, nframes
+        nframes -= n
+    return None, 0
 
-from .eiger import get_header_binary, get_valid_keys
 
 def compress_file(filename, outfile="out.bin", version="v1.3.0", mask=None,
-                  verbose=False):
+                  verbose=False, block_size=16, detector_mask=True,
+                  nbytes='auto', scan_max=False, bnl_version=2,
+                  encoding='varint', codec=None, level=None,
+                  block_frames=64, dqmap=None, compact=False,
+                  tile_shape=(256, 256), resume=False,
+                  checkpoint_frames=1000, follow=False, follow_timeout=60.,
+                  poll_interval=1., expected_frames=None, beg=0, end=None,
+                  stride=1, keys=None, write_index=None):
     '''
         Compress an EIGER hdf5 file into a BNL Multifile compressed format.
 
@@ -22,50 +302,258 @@ def compress_file(filename, outfile="out.bin", version="v1.3.0", mask=None,
             So just make sure "new" files have a version number string
             according to this format greater than this number and vice versa
             for older files
+        mask : np.ndarray, optional
+            only pixels where mask > 0 are kept
+        block_size : int, optional
+            number of frames read and searched for events at once
+        detector_mask : bool, optional
+            also exclude the pixels flagged in the EIGER pixel_mask, and
+            drop values above the count rate cutoff, and the largest value
+            of the data type, which flags dead and gap pixels
+        nbytes : int or 'auto', optional
+            bytes per stored value, 1, 2 or 4. 'auto' uses the smallest
+            width that holds the data type of the datasets, or the count
+            rate cutoff if it is smaller.
+        scan_max : bool, optional
+            with nbytes='auto', first read all the data to find the largest
+            value, so low count data can be stored with 1 byte per value.
+        bnl_version : int, optional
+            2 writes Version-COMP0002 files. 3 writes Version-COMP0003
+            files, where the positions are stored as varints of their
+            differences, about half the size.
+        encoding : str, optional
+            frame encoding of bnl_version 3 files, 'varint', 'ones'
+            (single photon events are stored without a value), or 'auto'
+            (each frame sparse, dense or as a dense box, whichever is
+            the smallest), or 'tiled' (events grouped by tiles of
+            tile_shape pixels, so regions of frames can be read alone)
+        codec : str, optional
+            'zlib' or 'lzma' to store the frames in compressed blocks of
+            block_frames frames, read back block by block by MultifileBNL.
+            bnl_version 3 only.
+        level : int, optional
+            the compression level of the codec
+        block_frames : int, optional
+            number of frames per compressed block
+        dqmap : np.ndarray, optional
+            the partitions (as for make_config_file). Only the pixels of
+            the partitions are kept, and they are renumbered so every
+            partition is a contiguous range of ids, stored in the file
+            (see partition_layout and MultifileBNL.rdpartframe).
+            bnl_version 3 only.
+        compact : bool, optional
+            store positions as ids of the pixels kept by the masks (see
+            compaction_layout), bnl_version 3 only. The table of the kept
+            pixels is stored once in the file.
+        tile_shape : tuple, optional
+            (rows, cols) of the tiles of the 'tiled' encoding, e.g. the
+            size of a detector module
+        write_index : bool, optional
+            end the file with an index footer (see MultifileBNLWriter), so
+            readers do not walk through the frames. By default only
+            bnl_version 3 files get one: readers of Version-COMP0002
+            files that don't know the footer take it for a frame.
+
+        resume : bool, optional
+            continue an interrupted compression from its last checkpoint
+            instead of starting over
+        checkpoint_frames : int, optional
+            the output is synced to disk and a checkpoint recorded about
+            every this many frames (rounded up to whole blocks)
+
+        follow : bool, optional
+            compress the file while it is being acquired: the data_
+            datasets are polled (opened SWMR when their file allows it)
+            for new keys and new frames, which are compressed as they
+            appear. With write_index, after every batch of new frames
+            the index footer of outfile + '.part' is updated, so the
+            frames so far can be read from it.
+        follow_timeout : float, optional
+            in follow mode, stop when no new frame appeared for this many
+            seconds (also the longest wait for the first dataset)
+        poll_interval : float, optional
+            in follow mode, seconds between polls of the file
+        expected_frames : int, optional
+            in follow mode, the number of frames of the acquisition, the
+            compression ends once they are all written. Defaults to the
+            nimages*ntrigger of the master file, if it has them.
+
+        beg, end, stride : int, optional
+            only compress the frames range(beg, end, stride), numbered
+            over all the data_ datasets in key order. Only the selected
+            frames are read, as hyperslabs of the datasets.
+        keys : list of str, optional
+            only compress the frames of these datasets, by key or by name
+            (e.g. ['data_000002']). The frames keep their numbers over
+            all the datasets for beg, end and stride.
+
+        With a selection of frames, the frame number in the EIGER file of
+        every compressed frame is stored in the 'source_frames' table of
+        bnl_version 3 outputs (MultifileBNL.source_frames), and saved next
+        to bnl_version 2 outputs in outfile + '.frames.npy', which keep
+        the Version-COMP0002 layout.
+
+        The output is written to outfile + '.part' and renamed to outfile
+        once complete, so outfile only ever holds complete files. While
+        running, outfile + '.ckpt' records the number of frames safely
+        written and the byte offset they end at, and the next frame to
+        compress (its dataset and frame in it). With resume=True, the
+        partial file is checked against the checkpoint, truncated at that
+        offset, and the compression continues with that next frame.
+
+        If a mask is applied, the pixels kept are saved next to the output
+        in outfile + '.mask.npy'.
     '''
 
-    # open and close file, figure out what the valid keys are
-    dset_keys, dims_per_key = get_valid_keys(filename, version=version)
+    import h5py
 
-    Nkeys = len(dset_keys)
-    nimgs = dims_per_key[0]
-    dims = dims_per_key[1:]
+    check_bnl_version(bnl_version, codec=codec)
 
-    dset_min = 1
-    dset_max = Nkeys+1
+    selected = (beg, end, stride, keys) != (0, None, 1, None)
+    if follow:
+        if selected:
+            raise ValueError("Error, a selection of frames can't be used "
+                             "with follow")
+        if scan_max:
+            raise ValueError("Error, scan_max needs all the frames, it "
+                             "can't be used with follow")
+        live = _LiveDatasets(filename, version=version)
+        if not live.wait(follow_timeout, poll_interval):
+            live.close()
+            raise TimeoutError("Error, no data_ dataset in {} after {} s"
+                               .format(filename, follow_timeout))
+        dset_keys = live.keys
+        dims = live.dsets[0].shape[1:]
+        dtype = live.dsets[0].dtype
+        if expected_frames is None:
+            expected_frames = get_nframes(filename)
+    else:
+        # open and close file, figure out what the valid keys are
+        dset_keys, dims_per_key = get_valid_keys(filename, version=version)
 
-    arr = np.zeros(dims, dtype=np.uint16)
+        dims = dims_per_key[1:]
 
-    # re-open file and close again, get header
-    header = get_header_binary(filename, dims, version=version)
+        f = h5py.File(filename, "r")
 
-    # open the output file, start writing
-    fout = open(outfile, "wb")
-    fout.write(header)
+        # read in the data type of the file, 16 or 32 bit
+        dtype = f[dset_keys[0]].dtype
+        nimgs = [f[dset_key].shape[0] for dset_key in dset_keys]
+        slabs, source_frames = _select_frames(dset_keys, nimgs, beg=beg,
+                                              end=end, stride=stride,
+                                              keys=keys)
+    block = np.zeros((block_size,) + tuple(dims), dtype=dtype)
 
-    f = h5py.File(filename)
+    good = None
+    if mask is not None:
+        good = np.asarray(mask) > 0
+    max_value = None
+    if detector_mask:
+        pixel_mask = get_pixel_mask(filename)
+        if pixel_mask is not None:
+            good = pixel_mask if good is None else good & pixel_mask
+        # the largest value of the data type flags dead and gap pixels,
+        # whatever the cutoff
+        max_value = np.iinfo(dtype).max - 1
+        cutoff = get_count_cutoff(filename)
+        if cutoff is not None:
+            max_value = min(cutoff, max_value)
+    if good is not None:
+        np.save(outfile + ".mask.npy", good)
+    # the mask is applied as a list of excluded pixels, computed once
+    masked = mask_to_index(good)
 
-    for dset_key in tqdm(dset_keys):
-        if verbose:
-            print("reading dataset {}".format(dset_key))
-        for j in range(nimgs):
-            dset = f[dset_key]
-            # this is an important trick to ensure the reading is blazingly
-            # fast. Doing this incorrectly can result in a significant
-            # reduction in performance! At least a factor of 10!
-            dset.read_direct(arr, np.s_[j,:,:])
+    tables, ids = pixel_layout(dims, mask=good, dqmap=dqmap,
+                               compact=compact, bnl_version=bnl_version)
+    if selected and bnl_version == 3:
+        tables = dict(tables or {}, source_frames=source_frames)
+    elif selected:
+        np.save(outfile + ".frames.npy", source_frames)
 
-            #test = np.array(f[key][j])
-            # TODO : Here we should use our own conditions to test
-            if mask is not None:
-                w, = np.where(((arr*mask).ravel() > 0))
-            else:
-                w, = np.where((arr.ravel() > 0))
+    partfile = outfile + ".part"
+    checkpoint = outfile + ".ckpt"
+    state = None
+    if resume and os.path.exists(checkpoint) and os.path.exists(partfile):
+        with open(checkpoint) as fck:
+            state = json.load(fck)
+        # the value width was chosen when the file was started
+        nbytes = int(np.frombuffer(bytes.fromhex(state['header'])[80:84],
+                                   dtype=np.uint32)[0])
+
+    vmax = None
+    if nbytes == 'auto' and scan_max:
+        vmax = 0
+        for frames in _read_blocks(f, slabs, block, verbose=verbose):
+            for pos, vals in encode_block(frames, masked,
+                                          max_value=max_value):
+                if len(vals):
+                    vmax = max(vmax, int(vals.max()))
+    nbytes, max_value = value_width(nbytes, dtype, max_value=max_value,
+                                    vmax=vmax)
+
+    # re-open file and close again, get header
+    magic = "Version-COMP{:04d}".format(bnl_version).encode()
+    header = get_header_binary(filename, dims, version=version,
+                               nbytes=nbytes, magic=magic)
 
-            #print("found {} items".format(len(w[0])))
-            fout.write(np.uint32(len(w)))
-            fout.write(w.astype(np.uint32))
-            fout.write(arr.ravel()[w])
+    if state is not None:
+        if state['header'] != header.hex():
+            raise ValueError("Error, {} was started with different "
+                             "parameters, can't resume".format(partfile))
+        logger.info("Resuming %s at frame %s", partfile, state['nframes'])
+
+    # open the output file, start writing
+    fout = MultifileBNLWriter(partfile, header, write_index=write_index,
+                              encoding=encoding, codec=codec, level=level,
+                              block_frames=block_frames,
+                              tile_shape=tile_shape, tables=tables,
+                              resume_offset=state and state['offset'])
+    start = len(fout)
+    if state is not None and start != state['nframes']:
+        raise ValueError("Error, {} holds {} frames, the checkpoint says {}"
+                         .format(partfile, start, state['nframes']))
+
+    if follow:
+        # the sizes are updated as the datasets grow
+        nimgs = live.sizes
+        blocks = _follow_blocks(live, block, start=start,
+                                nframes=expected_frames,
+                                timeout=follow_timeout,
+                                poll_interval=poll_interval,
+                                on_wait=(fout.update_index
+                                         if fout.write_index else None))
+    else:
+        blocks = _read_blocks(f, slabs, block, verbose=verbose,
+                              start=start)
+    # checkpoints are taken at the end of complete blocks
+    every = checkpoint_frames
+    if codec is not None:
+        every = -(-checkpoint_frames // block_frames)*block_frames
+    last = start
+    for frames in blocks:
+        frames = encode_block(frames, masked, max_value=max_value)
+        if ids is not None:
+            frames = renumber(frames, ids)
+        fout.write_frames(frames)
+        if len(fout) - last >= every:
+            nframes, offset = fout.checkpoint()
+            if follow:
+                n = nframes
+            elif nframes < len(source_frames):
+                n = int(source_frames[nframes])
+            else:
+                n = sum(nimgs)
+            dset_key, frame = _source_frame(dset_keys, nimgs, n)
+            _write_checkpoint(checkpoint, dict(
+                nframes=nframes, offset=offset, dataset=dset_key,
+                frame=frame, header=header.hex()))
+            last = nframes
 
     fout.close()
-    f.close()
+    if follow:
+        live.close()
+    else:
+        f.close()
+    # the complete file replaces the output at once
+    os.replace(partfile, outfile)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
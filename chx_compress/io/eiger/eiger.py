@@ -1,4 +1,3 @@
-import h5py
 import numpy as np
 
 import struct
@@ -14,14 +13,82 @@ EIGER_KEYS_DEFAULT = {
     'x_pixel_size' : "entry/instrument/detector/x_pixel_size",
     'y_pixel_size' : "entry/instrument/detector/y_pixel_size",
     'frame_time' : "entry/instrument/detector/frame_time",
+    'pixel_mask' : "entry/instrument/detector/detectorSpecific/pixel_mask",
+    'countrate_cutoff' :
+        "entry/instrument/detector/detectorSpecific/"
+        "countrate_correction_count_cutoff",
+    'nimages' : "entry/instrument/detector/detectorSpecific/nimages",
+    'ntrigger' : "entry/instrument/detector/detectorSpecific/ntrigger",
 }
 
-def get_header_binary(filename, dims, version="v1.3.0"):
+def _read_key(f, key):
+    ''' Read a scalar or array from an open hdf5 file.'''
+    return f[key][()]
+
+def get_pixel_mask(filename):
+    '''
+        Read the detector pixel mask of an EIGER master file.
+
+        Returns
+        -------
+        good : np.ndarray of bool or None
+            True for the pixels to keep (pixel_mask == 0), None if the
+            file has no pixel mask. Dead, gap and other flagged pixels
+            are False.
+    '''
+    import h5py
+
+    with h5py.File(filename, "r") as f:
+        if EIGER_KEYS_DEFAULT['pixel_mask'] not in f:
+            return None
+        return _read_key(f, EIGER_KEYS_DEFAULT['pixel_mask']) == 0
+
+def get_count_cutoff(filename):
+    '''
+        Read the count rate correction cutoff of an EIGER master file.
+
+        Values above the cutoff are saturated or invalid (e.g. 0xFFFF
+        in 16 bit images). Returns None if the file does not have it.
+    '''
+    import h5py
+
+    with h5py.File(filename, "r") as f:
+        if EIGER_KEYS_DEFAULT['countrate_cutoff'] not in f:
+            return None
+        return int(_read_key(f, EIGER_KEYS_DEFAULT['countrate_cutoff']))
+
+def get_nframes(filename):
+    '''
+        Read the number of frames of the acquisition (nimages per trigger
+        times ntrigger) from an EIGER master file.
+
+        The master file holds it from the start of the acquisition, so it
+        tells when a growing file is complete. Returns None if the file
+        does not have it.
+    '''
+    import h5py
+
+    with h5py.File(filename, "r") as f:
+        if EIGER_KEYS_DEFAULT['nimages'] not in f:
+            return None
+        nframes = int(_read_key(f, EIGER_KEYS_DEFAULT['nimages']))
+        if EIGER_KEYS_DEFAULT['ntrigger'] in f:
+            nframes *= int(_read_key(f, EIGER_KEYS_DEFAULT['ntrigger']))
+        return nframes
+
+def get_header_binary(filename, dims, version="v1.3.0", nbytes=2,
+                      magic=b"Version-COMP0002"):
     '''
         Make the BNL compressed version 1.0 format header.
 
         This returns a serialized form of the header.
+
+        nbytes : the bytes per value, 1, 2 or 4
+        magic : the format version, b"Version-COMP0002" or
+            b"Version-COMP0003" (encoded frames)
     '''
+    import h5py
+
     # this is copied from default in order to allow to mutate the dict for
     # different version EIGER's
     EIGER_KEYS = EIGER_KEYS_DEFAULT.copy()
@@ -40,21 +107,21 @@ def get_header_binary(filename, dims, version="v1.3.0"):
     # read in bytes
     # header is always from zero
     cur = 0
-    # this is version 2
-    header = b"Version-COMP0002"
-    header += struct.pack("@d", f[EIGER_KEYS['beam_center_x']].value)
-    header += struct.pack("@d", f[EIGER_KEYS['beam_center_y']].value)
-    header += struct.pack("@d", f[EIGER_KEYS['count_time']].value)
+    # this is version 2 (or 3)
+    header = magic
+    header += struct.pack("@d", _read_key(f, EIGER_KEYS['beam_center_x']))
+    header += struct.pack("@d", _read_key(f, EIGER_KEYS['beam_center_y']))
+    header += struct.pack("@d", _read_key(f, EIGER_KEYS['count_time']))
     # detector_distance
     header += struct.pack("@d", 0)
     # frame time
-    header += struct.pack("@d", f[EIGER_KEYS['frame_time']].value)
+    header += struct.pack("@d", _read_key(f, EIGER_KEYS['frame_time']))
     # incident wavelength
-    header += struct.pack("@d", f[EIGER_KEYS['wavelength']].value)
-    header += struct.pack("@d", f[EIGER_KEYS['x_pixel_size']].value)
-    header += struct.pack("@d", f[EIGER_KEYS['y_pixel_size']].value)
-    # bytes, we choose 2 here
-    header += struct.pack("@I", 2)
+    header += struct.pack("@d", _read_key(f, EIGER_KEYS['wavelength']))
+    header += struct.pack("@d", _read_key(f, EIGER_KEYS['x_pixel_size']))
+    header += struct.pack("@d", _read_key(f, EIGER_KEYS['y_pixel_size']))
+    # bytes per value
+    header += struct.pack("@I", nbytes)
     # nrows
     header += struct.pack("@I", dims[0])
     # ncols
@@ -78,6 +145,8 @@ def get_header_dict(filename, dims, version="v1.3.0"):
 
         This returns a dict version of the header
     '''
+    import h5py
+
     # this is copied from default in order to allow to mutate the dict for
     # different version EIGER's
     EIGER_KEYS = EIGER_KEYS_DEFAULT.copy()
@@ -99,17 +168,17 @@ def get_header_dict(filename, dims, version="v1.3.0"):
     # this is version 2
     header = dict()
     header['version'] = "Version-COMP0002"
-    header['beam_center_x'] = f[EIGER_KEYS['beam_center_x']].value
-    header['beam_center_y'] = f[EIGER_KEYS['beam_center_y']].value
-    header['count_time'] = f[EIGER_KEYS['count_time']].value
+    header['beam_center_x'] = _read_key(f, EIGER_KEYS['beam_center_x'])
+    header['beam_center_y'] = _read_key(f, EIGER_KEYS['beam_center_y'])
+    header['count_time'] = _read_key(f, EIGER_KEYS['count_time'])
     # detector_distance
     header['detector_distance'] = 0
     # frame time
-    header['frame_time'] = f[EIGER_KEYS['frame_time']].value
+    header['frame_time'] = _read_key(f, EIGER_KEYS['frame_time'])
     # incident wavelength
-    header['wavelength'] = f[EIGER_KEYS['wavelength']].value
-    header['x_pixel_size'] = f[EIGER_KEYS['x_pixel_size']].value
-    header['y_pixel_size'] = f[EIGER_KEYS['y_pixel_size']].value
+    header['wavelength'] = _read_key(f, EIGER_KEYS['wavelength'])
+    header['x_pixel_size'] = _read_key(f, EIGER_KEYS['x_pixel_size'])
+    header['y_pixel_size'] = _read_key(f, EIGER_KEYS['y_pixel_size'])
     # nrows
     header['nrows'] = dims[0]
     # ncols
@@ -125,6 +194,8 @@ def get_header_dict(filename, dims, version="v1.3.0"):
     return header
 
 def get_valid_keys(filename, version="v1.3.0"):
+    import h5py
+
     # the prefix of the data keys. Currently the same for all versions
     dset_pref="data_"
 
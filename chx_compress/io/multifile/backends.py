@@ -0,0 +1,205 @@
+'''
+I/O backends for the multifile readers.
+
+A backend exposes the raw bytes of a file through len() and slicing,
+which is all the readers need:
+
+    fd = open_backend(filename, 'pread')
+    dlen = np.frombuffer(fd[cur:cur+4], dtype="<u4")[0]
+
+    mmap    : np.memmap of the whole file (the original behaviour)
+    pread   : explicit os.pread calls through a readahead window. Large
+              reads instead of page faults, and no address space is
+              needed for the file (32-bit or memory-limited containers).
+    madvise : mmap whose madvise hint follows the access pattern,
+              MADV_SEQUENTIAL while frames are read in order and
+              MADV_RANDOM otherwise.
+
+See tests/bench_io_backends.py to compare them on a given filesystem.
+'''
+import mmap
+import os
+
+import numpy as np
+
+
+class MmapBackend:
+    ''' The whole file as a numpy memmap.'''
+    def __init__(self, filename):
+        self._mm = np.memmap(filename, dtype='c', mode='r')
+
+    def __len__(self):
+        return len(self._mm)
+
+    def __getitem__(self, s):
+        return self._mm[s]
+
+    def close(self):
+        self._mm = None
+
+
+class PreadBackend:
+    '''
+        Read with os.pread through a readahead window.
+
+        Every read that misses the window fetches a larger block starting
+        at the requested offset, so the small reads of a frame (dlen,
+        positions, values) and of consecutive small frames are coalesced
+        into large reads. As with kernel readahead, the block size starts
+        at min_read after a random jump and doubles with every miss that
+        continues the window, up to readahead.
+
+        Parameters
+        ----------
+        readahead : int, optional
+            the largest block size, in bytes
+        min_read : int, optional
+            the block size after a random jump, in bytes
+    '''
+    def __init__(self, filename, readahead=4*1024*1024, min_read=64*1024):
+        self._fd = os.open(filename, os.O_RDONLY)
+        self._size = os.fstat(self._fd).st_size
+        self.readahead = int(readahead)
+        self.min_read = int(min_read)
+        self._buf = b""
+        self._buf_start = 0
+        self._block = self.min_read
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, s):
+        start, stop, step = s.indices(self._size)
+        if step != 1:
+            raise ValueError("Only contiguous reads are supported")
+        size = max(stop - start, 0)
+        off = start - self._buf_start
+        if off < 0 or off + size > len(self._buf):
+            if 0 <= off <= len(self._buf):
+                self._block = min(2*self._block, self.readahead)
+            else:
+                self._block = self.min_read
+            self._buf = self._pread(start, max(size, self._block))
+            self._buf_start = start
+            off = 0
+        return memoryview(self._buf)[off:off + size]
+
+    def _pread(self, offset, size):
+        size = min(size, self._size - offset)
+        data = os.pread(self._fd, size, offset)
+        # pread may return less than asked for (e.g. on network filesystems)
+        while len(data) < size:
+            more = os.pread(self._fd, size - len(data), offset + len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._buf = b""
+
+
+class MadviseBackend:
+    '''
+        mmap with madvise hints that follow the access pattern.
+
+        After `threshold` consecutive forward reads the mapping is
+        advised MADV_SEQUENTIAL (aggressive readahead, early reclaim);
+        a backward or long forward jump switches it to MADV_RANDOM (no
+        wasted readahead). Platforms without madvise behave like mmap.
+
+        Parameters
+        ----------
+        access : {'auto', 'sequential', 'random'}, optional
+            'auto' follows the access pattern, the others fix the hint
+        threshold : int, optional
+            number of consecutive forward reads before switching to
+            sequential
+        max_gap : int, optional
+            largest forward jump (bytes) still counted as sequential
+    '''
+    def __init__(self, filename, access='auto', threshold=8,
+                 max_gap=1024*1024):
+        if access not in ('auto', 'sequential', 'random'):
+            raise ValueError("Error, access must be 'auto', 'sequential' "
+                             "or 'random', got : {}".format(access))
+        with open(filename, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._arr = np.frombuffer(self._mmap, dtype='c')
+        self.access = access
+        self.threshold = threshold
+        self.max_gap = max_gap
+        self._last_stop = 0
+        self._nforward = 0
+        self._advice = None
+        if access == 'sequential':
+            self._advise('sequential')
+        elif access == 'random':
+            self._advise('random')
+
+    def __len__(self):
+        return len(self._arr)
+
+    def __getitem__(self, s):
+        if self.access == 'auto':
+            start = int(s.start or 0)
+            if 0 <= start - self._last_stop <= self.max_gap:
+                self._nforward += 1
+                if self._nforward >= self.threshold:
+                    self._advise('sequential')
+            else:
+                self._nforward = 0
+                self._advise('random')
+            if s.stop is not None:
+                self._last_stop = int(s.stop)
+        return self._arr[s]
+
+    def _advise(self, advice):
+        if advice == self._advice:
+            return
+        flag = getattr(mmap, {'sequential': 'MADV_SEQUENTIAL',
+                              'random': 'MADV_RANDOM'}[advice], None)
+        if flag is not None and hasattr(self._mmap, "madvise"):
+            self._mmap.madvise(flag)
+        self._advice = advice
+
+    def close(self):
+        if self._mmap is not None:
+            # the numpy view must go before the map can be closed
+            self._arr = None
+            try:
+                self._mmap.close()
+            except BufferError:
+                # frames handed out still point into the map, it is
+                # released when they are
+                pass
+            self._mmap = None
+
+
+BACKENDS = {
+    'mmap': MmapBackend,
+    'pread': PreadBackend,
+    'madvise': MadviseBackend,
+}
+
+
+def open_backend(filename, backend='mmap', **kwargs):
+    ''' Open filename with the backend of the given name.
+
+        backend : str or callable
+            one of 'mmap', 'pread', 'madvise', or a callable
+            backend(filename, **kwargs) returning a backend object
+    '''
+    if callable(backend):
+        return backend(filename, **kwargs)
+    try:
+        cls = BACKENDS[backend]
+    except KeyError:
+        raise ValueError("Error, backend must be one of {}, got : {}"
+                         .format(list(BACKENDS), backend))
+    return cls(filename, **kwargs)
@@ -0,0 +1,67 @@
+'''
+A least recently used cache of decoded frames, bounded by total bytes.
+'''
+from collections import OrderedDict
+
+
+class FrameCache:
+    '''
+        LRU cache of numpy arrays with a total size budget.
+
+        Parameters
+        ----------
+        max_bytes : int
+            the budget in bytes. The least recently used entries are
+            evicted until the cached arrays fit within it. Arrays larger
+            than the budget are never cached.
+
+        The counters hits, misses and evictions can be used to size the
+        budget (see stats()).
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key):
+        ''' Return the cached array or None.'''
+        try:
+            arr = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return arr
+
+    def put(self, key, arr):
+        ''' Cache arr under key, evicting old entries as needed.'''
+        if arr.nbytes > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        while self._data and self.nbytes + arr.nbytes > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+        self._data[key] = arr
+        self.nbytes += arr.nbytes
+
+    def clear(self):
+        self._data.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, entries=len(self._data),
+                    nbytes=self.nbytes, max_bytes=self.max_bytes)
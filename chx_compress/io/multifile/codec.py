@@ -0,0 +1,368 @@
+'''
+Encodings of the frames of Version-COMP0003 BNL files.
+
+Every frame is a 12 byte record header, <u4 dlen, <u4 size, <u4 tag,
+followed by size bytes of payload encoded as given by tag:
+
+    FRAME_VARINT : the dlen positions as varints of their differences
+                   (the first one from 0), then dlen values
+    FRAME_ONES   : <u4 nones, <u4 nbytes of the next field, the positions
+                   of the events equal to 1 as FRAME_VARINT positions
+                   (no values), then the other dlen - nones events as a
+                   FRAME_VARINT payload
+    FRAME_DENSE  : the full frame, rows*cols values
+    FRAME_DENSE_ROI : <u4 rows_begin, rows_end, cols_begin, cols_end of
+                   the bounding box of the events, then the values of
+                   that box
+    FRAME_TILED  : the events grouped by tile of tile_shape (tiles
+                   numbered row by row): <u4 tile_dlens[ntiles], <u4
+                   tile_offsets[ntiles + 1], then a FRAME_VARINT payload
+                   per tile, at tile_offsets from the end of the table
+
+Most events of XPCS frames are single photons, FRAME_ONES stores no
+value for them. Bright frames are smaller dense than sparse, and the
+'auto' encoding picks the smallest of the sparse, dense and dense box
+encodings frame by frame, so no frame is larger than its dense size.
+Reading a region of a tiled frame only reads the tiles it overlaps.
+
+Positions in a frame are sorted and mostly close to each other, so most
+differences take 1 or 2 bytes instead of 4. Encoding and decoding are
+done with whole array operations, with a loop over the (at most 5)
+bytes of a varint but not over the events.
+
+Files of either version can also be stored as compressed blocks of
+frame records (see compress_block): every block is a <u4 size, <u4
+nframes block header, then size bytes of zlib or lzma data.
+'''
+import lzma
+import zlib
+
+import numpy as np
+
+RECORD_HEADER_DTYPE = np.dtype([('dlen', '<u4'), ('size', '<u4'),
+                                ('tag', '<u4')])
+RECORD_HEADER_SIZE = RECORD_HEADER_DTYPE.itemsize
+
+FRAME_VARINT = 0
+FRAME_ONES = 1
+FRAME_DENSE = 2
+FRAME_DENSE_ROI = 3
+FRAME_TILED = 4
+
+# the encodings that can be asked for by name, 'auto' picks one per frame
+ENCODINGS = {'varint': FRAME_VARINT, 'ones': FRAME_ONES,
+             'dense': FRAME_DENSE, 'dense_roi': FRAME_DENSE_ROI,
+             'tiled': FRAME_TILED, 'auto': None}
+
+# the codecs of the block container, 0 is no blocks
+BLOCK_CODECS = {'zlib': 1, 'lzma': 2}
+BLOCK_HEADER_DTYPE = np.dtype([('size', '<u4'), ('nframes', '<u4')])
+BLOCK_HEADER_SIZE = BLOCK_HEADER_DTYPE.itemsize
+
+# 7 bits per byte, the high bit is set on all bytes but the last
+_VARINT_MAX_BYTES = 5
+
+
+def _varint_nbytes(values):
+    ''' The number of bytes of the varint of every value.'''
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, _VARINT_MAX_BYTES):
+        nbytes += values >= np.uint64(1 << 7*k)
+    return nbytes
+
+
+def varint_encode(values):
+    ''' Encode unsigned integers (< 2**35) as LEB128 varints.
+
+        Returns a uint8 array.
+    '''
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = _varint_nbytes(values)
+    starts = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(_VARINT_MAX_BYTES):
+        w = nbytes > k
+        if not w.any():
+            break
+        byte = (values[w] >> np.uint64(7*k)) & np.uint64(0x7f)
+        byte |= np.where(nbytes[w] > k + 1, 0x80, 0).astype(np.uint64)
+        out[starts[w] + k] = byte
+    return out
+
+
+def varint_decode(buf):
+    ''' Decode a uint8 array of LEB128 varints, returns a uint64 array.'''
+    buf = np.frombuffer(buf, dtype=np.uint8)
+    ends = np.flatnonzero(buf < 0x80)
+    if len(ends) and ends[-1] != len(buf) - 1:
+        raise ValueError("Error, truncated varint")
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    nbytes = ends - starts + 1
+    values = (buf[starts] & 0x7f).astype(np.uint64)
+    for k in range(1, _VARINT_MAX_BYTES):
+        w = np.flatnonzero(nbytes > k)
+        if len(w) == 0:
+            break
+        byte = (buf[starts[w] + k] & 0x7f).astype(np.uint64)
+        values[w] |= byte << np.uint64(7*k)
+    return values
+
+
+def encode_positions(pos):
+    ''' Encode sorted positions as varints of their differences.'''
+    pos = np.asarray(pos, dtype=np.int64)
+    return varint_encode(np.diff(pos, prepend=0))
+
+
+def decode_positions(buf):
+    ''' Decode positions written by encode_positions, as uint32.'''
+    return np.cumsum(varint_decode(buf), dtype=np.uint64).astype(np.uint32)
+
+
+def _merge(ones, pos, vals):
+    ''' Merge the value 1 events into the sorted (pos, vals) events.'''
+    # where the other events go in the merged frame
+    where = np.searchsorted(ones, pos) + np.arange(len(pos))
+    merged_pos = np.empty(len(ones) + len(pos), dtype=np.uint32)
+    merged_vals = np.ones(len(merged_pos), dtype=vals.dtype)
+    is_one = np.ones(len(merged_pos), dtype=bool)
+    is_one[where] = False
+    merged_pos[where] = pos
+    merged_pos[is_one] = ones
+    merged_vals[where] = vals
+    return merged_pos, merged_vals
+
+
+def _bounding_box(pos, shape):
+    ''' Return (rows_begin, rows_end, cols_begin, cols_end) around pos.'''
+    if len(pos) == 0:
+        return 0, 0, 0, 0
+    rows, cols = np.divmod(np.asarray(pos, dtype=np.int64), shape[1])
+    # positions are sorted, so the rows are too
+    return (int(rows[0]), int(rows[-1]) + 1,
+            int(cols.min()), int(cols.max()) + 1)
+
+
+def _encode_dense(pos, vals, valtype, shape, box=None):
+    ''' The frame, or only the box of it, as a dense array of valtype.'''
+    img = np.zeros(shape[0]*shape[1], dtype=valtype)
+    img[pos] = vals
+    img = img.reshape(shape)
+    if box is not None:
+        r0, r1, c0, c1 = box
+        img = np.ascontiguousarray(img[r0:r1, c0:c1])
+    return img
+
+
+def _tile_numbers(pos, shape, tile_shape):
+    rows, cols = np.divmod(np.asarray(pos, dtype=np.int64), shape[1])
+    ntile_cols = -(-shape[1] // tile_shape[1])
+    return (rows // tile_shape[0])*ntile_cols + cols // tile_shape[1]
+
+
+def _ntiles(shape, tile_shape):
+    return -(-shape[0] // tile_shape[0])*-(-shape[1] // tile_shape[1])
+
+
+def tiles_of_roi(roi, shape, tile_shape):
+    ''' The numbers of the tiles overlapping
+        roi = (rows_begin, rows_end, cols_begin, cols_end).
+    '''
+    r0, r1, c0, c1 = roi
+    ntile_cols = -(-shape[1] // tile_shape[1])
+    trows = np.arange(r0 // tile_shape[0], -(-r1 // tile_shape[0]))
+    tcols = np.arange(c0 // tile_shape[1], -(-c1 // tile_shape[1]))
+    return (trows[:, None]*ntile_cols + tcols[None, :]).ravel()
+
+
+def _encode_tiled(pos, vals, shape, tile_shape):
+    pos = np.asarray(pos, dtype=np.int64)
+    ntiles = _ntiles(shape, tile_shape)
+    tiles = _tile_numbers(pos, shape, tile_shape)
+    # stable, so the positions stay sorted in every tile
+    order = np.argsort(tiles, kind='stable')
+    pos, vals, tiles = pos[order], vals[order], tiles[order]
+    bounds = np.searchsorted(tiles, np.arange(ntiles + 1))
+    tile_dlens = np.diff(bounds)
+    # differences of positions, from 0 for the first one of every tile
+    deltas = np.diff(pos, prepend=0)
+    firsts = bounds[:-1][tile_dlens > 0]
+    deltas[firsts] = pos[firsts]
+    positions = varint_encode(deltas)
+    pos_bounds = np.concatenate([[0], np.cumsum(_varint_nbytes(
+        deltas.astype(np.uint64)))])[bounds]
+    tile_bytes = np.diff(pos_bounds) + tile_dlens*vals.itemsize
+    tile_offsets = np.concatenate([[0], np.cumsum(tile_bytes)])
+    pieces = [tile_dlens.astype('<u4'), tile_offsets.astype('<u4')]
+    for tile in np.flatnonzero(tile_dlens):
+        pieces.append(positions[pos_bounds[tile]:pos_bounds[tile+1]])
+        pieces.append(vals[bounds[tile]:bounds[tile+1]])
+    return pieces
+
+
+def decode_tiles(read, valtype, shape, tile_shape, tiles=None):
+    ''' Decode the tiles of a FRAME_TILED frame into (pos, vals), the
+        positions are sorted tile by tile.
+
+        read : a function returning the bytes a:b of the payload for
+            read(a, b), so only the table and the tiles asked for are read
+        tiles : the tile numbers, all tiles by default
+    '''
+    ntiles = _ntiles(shape, tile_shape)
+    table = np.frombuffer(read(0, 4*(2*ntiles + 1)), dtype='<u4')
+    tile_dlens, tile_offsets = table[:ntiles], table[ntiles:]
+    start = 4*(2*ntiles + 1)
+    if tiles is None:
+        tiles = np.arange(ntiles)
+    tiles = np.asarray(tiles)
+    tiles = tiles[(tiles < ntiles)]
+    tiles = tiles[tile_dlens[tiles] > 0]
+    itemsize = np.dtype(valtype).itemsize
+    pos, vals = [np.zeros(0, dtype=np.uint32)], [np.zeros(0, dtype=valtype)]
+    for tile in tiles:
+        data = read(start + int(tile_offsets[tile]),
+                    start + int(tile_offsets[tile + 1]))
+        tile_pos, tile_vals = _decode_varint(data, int(tile_dlens[tile]),
+                                             valtype)
+        pos.append(tile_pos)
+        vals.append(tile_vals)
+    return np.concatenate(pos), np.concatenate(vals)
+
+
+def encode_frame(pos, vals, valtype, encoding=FRAME_VARINT, shape=None,
+                 tile_shape=None):
+    ''' Encode one frame, returns (tag, list of payload buffers).
+
+        encoding : one of the FRAME_* tags, or None to use the smallest
+            of FRAME_VARINT, FRAME_DENSE and FRAME_DENSE_ROI
+        shape : the frame shape, needed by the dense and tiled encodings
+        tile_shape : the tile shape of the tiled encoding
+    '''
+    vals = np.ascontiguousarray(vals, dtype=valtype)
+    if encoding is None:
+        nbytes = np.dtype(valtype).itemsize
+        positions = encode_positions(pos)
+        box = _bounding_box(pos, shape)
+        sizes = [len(positions) + vals.nbytes,
+                 shape[0]*shape[1]*nbytes,
+                 16 + (box[1] - box[0])*(box[3] - box[2])*nbytes]
+        encoding = [FRAME_VARINT, FRAME_DENSE,
+                    FRAME_DENSE_ROI][int(np.argmin(sizes))]
+        if encoding == FRAME_VARINT:
+            return FRAME_VARINT, [positions, vals]
+    if encoding == FRAME_VARINT:
+        return FRAME_VARINT, [encode_positions(pos), vals]
+    if encoding == FRAME_ONES:
+        pos = np.asarray(pos)
+        w = vals == 1
+        ones = encode_positions(pos[w])
+        head = np.array([np.count_nonzero(w), len(ones)], dtype='<u4')
+        return FRAME_ONES, [head, ones, encode_positions(pos[~w]), vals[~w]]
+    if encoding == FRAME_DENSE:
+        return FRAME_DENSE, [_encode_dense(pos, vals, valtype, shape)]
+    if encoding == FRAME_DENSE_ROI:
+        box = _bounding_box(pos, shape)
+        return FRAME_DENSE_ROI, [np.array(box, dtype='<u4'),
+                                 _encode_dense(pos, vals, valtype, shape, box)]
+    if encoding == FRAME_TILED:
+        return FRAME_TILED, _encode_tiled(pos, vals, shape, tile_shape)
+    raise ValueError("Error, unknown frame encoding : {}".format(encoding))
+
+
+def _decode_varint(payload, dlen, valtype):
+    nval = dlen*np.dtype(valtype).itemsize
+    npos = len(payload) - nval
+    pos = decode_positions(payload[:npos])
+    vals = np.frombuffer(payload[npos:], dtype=valtype)
+    if len(pos) != dlen:
+        raise ValueError("Error, frame has {} positions, expected {}"
+                         .format(len(pos), dlen))
+    return pos, vals
+
+
+def decode_split_frame(tag, payload, dlen, valtype, shape=None,
+                       tile_shape=None):
+    ''' Decode the payload of one frame into (ones, pos, vals): the
+        positions of the events equal to 1, and the other events.
+
+        Frames not encoded with FRAME_ONES are split after decoding.
+    '''
+    if tag == FRAME_ONES:
+        nones, nbytes = np.frombuffer(payload[:8], dtype='<u4')
+        nones, nbytes = int(nones), int(nbytes)
+        ones = decode_positions(payload[8:8 + nbytes])
+        pos, vals = _decode_varint(payload[8 + nbytes:], dlen - nones,
+                                   valtype)
+        return ones, pos, vals
+    pos, vals = decode_frame(tag, payload, dlen, valtype, shape=shape,
+                             tile_shape=tile_shape)
+    w = vals == 1
+    return pos[w], pos[~w], vals[~w]
+
+
+def decode_dense(tag, payload, valtype, shape):
+    ''' Return ((rows_begin, rows_end, cols_begin, cols_end), values) of
+        a frame stored dense, the values are a 2D view of the payload.
+        Returns None for the sparse encodings.
+    '''
+    if tag == FRAME_DENSE:
+        box = (0, shape[0], 0, shape[1])
+        vals = np.frombuffer(payload, dtype=valtype)
+    elif tag == FRAME_DENSE_ROI:
+        box = tuple(int(b) for b in np.frombuffer(payload[:16], dtype='<u4'))
+        vals = np.frombuffer(payload[16:], dtype=valtype)
+    else:
+        return None
+    r0, r1, c0, c1 = box
+    return box, vals.reshape(r1 - r0, c1 - c0)
+
+
+def decode_frame(tag, payload, dlen, valtype, shape=None, tile_shape=None):
+    ''' Decode the payload of one frame into (pos, vals).
+
+        shape : the frame shape, needed by the dense and tiled encodings
+        tile_shape : the tile shape of the tiled encoding
+    '''
+    if tag == FRAME_VARINT:
+        return _decode_varint(payload, dlen, valtype)
+    if tag == FRAME_TILED:
+        pos, vals = decode_tiles(lambda a, b: payload[a:b], valtype, shape,
+                                 tile_shape)
+        order = np.argsort(pos, kind='stable')
+        return pos[order], vals[order]
+    if tag == FRAME_ONES:
+        return _merge(*decode_split_frame(tag, payload, dlen, valtype))
+    dense = decode_dense(tag, payload, valtype, shape)
+    if dense is None:
+        raise ValueError("Error, unknown frame encoding : {}".format(tag))
+    (r0, r1, c0, c1), img = dense
+    rows, cols = np.nonzero(img)
+    pos = ((rows + r0)*shape[1] + cols + c0).astype(np.uint32)
+    return pos, img[rows, cols]
+
+
+def compress_block(data, codec, level=None):
+    ''' Compress the records of a block with one of BLOCK_CODECS.
+
+        level : the zlib level (default 6) or lzma preset (default 6)
+    '''
+    if level is None:
+        level = 6
+    if codec == BLOCK_CODECS['zlib']:
+        return zlib.compress(data, level)
+    if codec == BLOCK_CODECS['lzma']:
+        return lzma.compress(data, preset=level)
+    raise ValueError("Error, unknown block codec : {}".format(codec))
+
+
+def decompress_block(data, codec):
+    ''' Decompress a block, returns a uint8 array.'''
+    if codec == BLOCK_CODECS['zlib']:
+        data = zlib.decompress(data)
+    elif codec == BLOCK_CODECS['lzma']:
+        data = lzma.decompress(data)
+    else:
+        raise ValueError("Error, unknown block codec : {}".format(codec))
+    return np.frombuffer(data, dtype=np.uint8)
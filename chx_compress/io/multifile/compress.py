@@ -0,0 +1,336 @@
+'''
+Compression of frames into BNL multifiles, from any source of frames.
+
+The frames are searched for events (the nonzero, unmasked pixels) a
+block of frames at a time, and written with MultifileBNLWriter.
+compress_file (in io/eiger) reads the frames of EIGER files.
+'''
+import itertools
+
+import numpy as np
+
+from .multifile import BNL_MAGIC, BNL_MAGIC_V3, pack_bnl_header
+from .writer import MultifileBNLWriter
+
+
+def mask_to_index(mask):
+    ''' Precompute a mask as the flat indices of the excluded pixels.
+
+        Pixels are kept where mask > 0, as for (arr*mask) > 0.
+        Returns None if nothing is excluded.
+    '''
+    if mask is None:
+        return None
+    masked = np.flatnonzero(np.asarray(mask).ravel() <= 0)
+    if len(masked) == 0:
+        return None
+    return masked
+
+
+def partition_layout(dqmap, mask=None):
+    '''
+        Number the pixels of the partitions of dqmap so that every
+        partition is a contiguous range of pixel ids.
+
+        Parameters
+        ----------
+        dqmap : np.ndarray
+            the partition labels, pixels with labels <= 0 are not in any
+            partition (as for make_config_file)
+        mask : np.ndarray, optional
+            only pixels where mask > 0 are kept
+
+        Returns
+        -------
+        tables : dict
+            'pixels', the detector position of every pixel id,
+            'partition_labels', the labels in increasing order, and
+            'partition_bounds', the partition of label partition_labels[i]
+            being the ids partition_bounds[i]:partition_bounds[i+1]
+        ids : np.ndarray
+            the pixel id of every detector position, -1 for the pixels
+            not kept
+    '''
+    labels = np.asarray(dqmap).ravel()
+    keep = labels > 0
+    if mask is not None:
+        keep &= np.asarray(mask).ravel() > 0
+    pixels = np.flatnonzero(keep)
+    # stable, so the pixels of a partition stay in detector order
+    pixels = pixels[np.argsort(labels[pixels], kind='stable')]
+    partition_labels, counts = np.unique(labels[pixels], return_counts=True)
+    partition_bounds = np.concatenate([[0], np.cumsum(counts)])
+    ids = np.full(len(labels), -1, dtype=np.int64)
+    ids[pixels] = np.arange(len(pixels))
+    tables = dict(pixels=pixels.astype(np.uint32),
+                  partition_labels=partition_labels,
+                  partition_bounds=partition_bounds.astype(np.int64))
+    return tables, ids
+
+
+def compaction_layout(mask, shape):
+    '''
+        Number the pixels kept by mask (where mask > 0) in detector order.
+
+        Returns
+        -------
+        tables : dict
+            'pixels', the detector position of every pixel id
+        ids : np.ndarray
+            the pixel id of every detector position, -1 for the pixels
+            not kept
+    '''
+    if mask is None:
+        pixels = np.arange(shape[0]*shape[1])
+    else:
+        pixels = np.flatnonzero(np.asarray(mask).ravel() > 0)
+    ids = np.full(shape[0]*shape[1], -1, dtype=np.int64)
+    ids[pixels] = np.arange(len(pixels))
+    return dict(pixels=pixels.astype(np.uint32)), ids
+
+
+def renumber(frames, ids):
+    ''' Replace the positions of frames (a list of (pos, vals)) by their
+        pixel ids, dropping pixels with no id and sorting by id.
+    '''
+    for pos, vals in frames:
+        pos = ids[pos]
+        keep = pos >= 0
+        pos, vals = pos[keep], vals[keep]
+        order = np.argsort(pos, kind='stable')
+        yield pos[order], vals[order]
+
+
+def encode_block(block, masked=None, max_value=None):
+    '''
+        Find the events (nonzero, unmasked pixels) of a block of frames.
+
+        Parameters
+        ----------
+        block : np.ndarray
+            the frames, of shape (nframes, rows, cols). The masked pixels
+            are zeroed in place.
+        masked : np.ndarray, optional
+            flat indices of the excluded pixels (see mask_to_index)
+        max_value : int, optional
+            events above this value (saturated or flagged pixels) are
+            dropped
+
+        Returns
+        -------
+        frames : list of (pos, vals), one per frame
+
+        The nonzero search is done once over the whole block, with no
+        per-frame temporaries.
+    '''
+    nframes = block.shape[0]
+    flat = block.reshape(nframes, -1)
+    npix = flat.shape[1]
+    if masked is not None:
+        flat[:, masked] = 0
+    w = np.flatnonzero(flat)
+    vals = flat.ravel()[w]
+    if max_value is not None:
+        # only the events are tested, not the full frames
+        keep = vals <= max_value
+        if not keep.all():
+            w, vals = w[keep], vals[keep]
+    bounds = np.searchsorted(w, np.arange(nframes + 1)*npix)
+    frames = list()
+    for i in range(nframes):
+        b0, b1 = bounds[i], bounds[i+1]
+        frames.append((w[b0:b1] - i*npix, vals[b0:b1]))
+    return frames
+
+
+def value_nbytes(max_value):
+    ''' The smallest number of bytes (1, 2 or 4) that holds max_value.'''
+    for nbytes in (1, 2, 4):
+        if max_value < 1 << 8*nbytes:
+            return nbytes
+    raise ValueError("Error, values up to {} don't fit in 4 bytes"
+                     .format(max_value))
+
+
+def value_width(nbytes, dtype, max_value=None, vmax=None):
+    '''
+        Choose the bytes per stored value, and the largest value kept.
+
+        Parameters
+        ----------
+        nbytes : int or 'auto'
+            1, 2 or 4, or 'auto' for the smallest width that holds vmax,
+            or else the largest value of dtype (and max_value)
+        dtype : np.dtype
+            the data type of the frames
+        max_value : int, optional
+            events above this value are dropped
+        vmax : int, optional
+            the largest value of the data, if it was scanned for
+
+        Returns
+        -------
+        nbytes : int
+        max_value : int
+            at most the largest value nbytes hold: values that don't fit
+            are dropped, not wrapped
+    '''
+    if nbytes == 'auto':
+        if vmax is None:
+            if np.issubdtype(dtype, np.integer):
+                vmax = np.iinfo(dtype).max
+                if max_value is not None:
+                    vmax = min(vmax, max_value)
+            elif max_value is not None:
+                vmax = max_value
+            else:
+                raise ValueError("Error, nbytes='auto' needs max_value with "
+                                 "frames of type {}".format(dtype))
+        nbytes = value_nbytes(vmax)
+    elif nbytes not in (1, 2, 4):
+        raise ValueError("Error, nbytes must be 1, 2, 4 or 'auto', got : {}"
+                         .format(nbytes))
+    vlimit = (1 << 8*nbytes) - 1
+    max_value = vlimit if max_value is None else min(max_value, vlimit)
+    return nbytes, max_value
+
+
+def check_bnl_version(bnl_version, codec=None):
+    ''' Check the output version, and that it can store the frames in
+        blocks of codec.
+    '''
+    if bnl_version not in (2, 3):
+        raise ValueError("Error, bnl_version must be 2 or 3, got : {}"
+                         .format(bnl_version))
+    if codec is not None and bnl_version != 3:
+        raise ValueError("Error, codec needs bnl_version 3, got : {}"
+                         .format(bnl_version))
+
+
+def pixel_layout(shape, mask=None, dqmap=None, compact=False,
+                 bnl_version=3):
+    '''
+        Choose how the stored positions number the pixels.
+
+        Returns (tables, ids) of partition_layout with a dqmap, of
+        compaction_layout with compact, or (None, None) when positions
+        are detector positions.
+
+        The pixel tables are only stored in Version-COMP0003 files, the
+        readers of Version-COMP0002 files don't know them.
+    '''
+    if (dqmap is not None or compact) and bnl_version != 3:
+        raise ValueError("Error, dqmap and compact need bnl_version 3, "
+                         "got : {}".format(bnl_version))
+    if dqmap is not None:
+        return partition_layout(dqmap, mask=mask)
+    if compact:
+        return compaction_layout(mask, shape)
+    return None, None
+
+
+def _batches(frames, block_size):
+    ''' Yield the frames as 3D arrays of at most block_size frames.
+
+        frames is a 2D or 3D array (or memmap), or an iterable of frames
+        or batches of frames.
+    '''
+    if hasattr(frames, 'ndim'):
+        frames = [frames]
+    for batch in frames:
+        batch = np.asarray(batch)
+        if batch.ndim == 2:
+            batch = batch[np.newaxis]
+        if batch.ndim != 3:
+            raise ValueError("Error, frames must be 2D, or 3D batches of "
+                             "frames, got : {}D".format(batch.ndim))
+        for i in range(0, len(batch), block_size):
+            yield batch[i:i+block_size]
+
+
+def compress_stream(frames, header, outfile, mask=None, max_value=None,
+                    nbytes='auto', block_size=16, bnl_version=2,
+                    encoding='varint', codec=None, level=None,
+                    block_frames=64, dqmap=None, compact=False,
+                    tile_shape=(256, 256), write_index=None):
+    '''
+        Compress frames from memory into a BNL Multifile compressed
+        format.
+
+        Parameters
+        ----------
+        frames : np.ndarray or iterable
+            a 3D array of frames (e.g. a memmapped .npy stack, from
+            np.load(filename, mmap_mode='r')), or an iterable (e.g. a
+            generator) of frames or of 3D batches of frames. The frames
+            are not modified.
+        header : dict
+            the fields of the main header (see BNL_HEADER_KEYS), e.g.
+            frame_time or x_pixel_size. nrows and ncols default to the
+            frame shape, and bytes is set from nbytes.
+        outfile : str
+        mask : np.ndarray, optional
+            only pixels where mask > 0 are kept
+        max_value : int, optional
+            events above this value (saturated or flagged pixels) are
+            dropped
+        nbytes : int or 'auto', optional
+            bytes per stored value, 1, 2 or 4. 'auto' uses the smallest
+            width that holds max_value, or else the integer data type of
+            the frames.
+        block_size : int, optional
+            number of frames searched for events at once
+
+        The other parameters are as for compress_file: bnl_version,
+        encoding, codec, level, block_frames, dqmap, compact, tile_shape
+        and write_index (by default, only bnl_version 3 files get an
+        index footer).
+
+        Returns
+        -------
+        nframes : int
+            the number of frames written
+
+        Example
+        -------
+            frames = np.load("sim.npy", mmap_mode='r')
+            compress_stream(frames, dict(frame_time=.01), "sim.bin")
+    '''
+    check_bnl_version(bnl_version, codec=codec)
+    batches = _batches(frames, block_size)
+    # the first batch gives the frame shape and data type
+    first = next(batches, None)
+    if first is None:
+        raise ValueError("Error, no frames to compress")
+    dims = first.shape[1:]
+
+    nbytes, max_value = value_width(nbytes, first.dtype,
+                                    max_value=max_value)
+    masked = mask_to_index(mask)
+    tables, ids = pixel_layout(dims, mask=mask, dqmap=dqmap,
+                               compact=compact, bnl_version=bnl_version)
+
+    md = dict(header)
+    md.setdefault('nrows', dims[0])
+    md.setdefault('ncols', dims[1])
+    md['bytes'] = nbytes
+    magic = BNL_MAGIC_V3 if bnl_version == 3 else BNL_MAGIC
+    header = pack_bnl_header(md, magic=magic)
+
+    # the frames are copied into block, the search zeroes masked pixels
+    block = np.empty((block_size,) + dims, dtype=first.dtype)
+    with MultifileBNLWriter(outfile, header, write_index=write_index,
+                            encoding=encoding, codec=codec, level=level,
+                            block_frames=block_frames, tile_shape=tile_shape,
+                            tables=tables) as fout:
+        for batch in itertools.chain([first], batches):
+            if batch.shape[1:] != dims:
+                raise ValueError("Error, frames of shape {}, expected {}"
+                                 .format(batch.shape[1:], dims))
+            nread = len(batch)
+            block[:nread] = batch
+            batch = encode_block(block[:nread], masked, max_value=max_value)
+            if ids is not None:
+                batch = renumber(batch, ids)
+            fout.write_frames(batch)
+        return len(fout)
@@ -0,0 +1,154 @@
+'''
+Convert between the APS (one 1024 byte header per frame) and BNL (one
+main header, then dlen per frame) multifile layouts.
+
+Both layouts store the same sparse block per frame: dlen 4 byte
+positions followed by dlen values. The conversion copies these blocks
+as they are, without decoding or densifying frames. The output offsets
+of all frames are computed up front, so the frames are split in ranges
+that separate processes write directly at their final place.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+
+from .multifile import (APS_HEADER_DTYPE, BNL_EXT_HEADER_KEYS, BNL_MAGIC,
+                        MultifileAPS, open_multifile, pack_bnl_footer,
+                        pack_bnl_header)
+
+
+def _record_layout(src):
+    ''' Return the offsets of the sparse blocks in src, their sizes and
+        the number of bytes per value.
+    '''
+    dlens = np.asarray(src.dlens, dtype=np.int64)
+    if isinstance(src, MultifileAPS):
+        nbytes = np.unique(src._frame_nbytes)
+        if len(nbytes) != 1:
+            raise ValueError("Error, frames with different value sizes "
+                             "({}) can't be converted".format(nbytes))
+        nbytes = int(nbytes[0])
+        skip = src.HEADER_SIZE
+    else:
+        if src.magic != BNL_MAGIC and src._version > 1:
+            raise ValueError("Error, only {} BNL files can be converted, "
+                             "got : {}".format(BNL_MAGIC, src.magic))
+        if src.codec or src.tables:
+            raise ValueError("Error, files in compressed blocks or with "
+                             "tables can't be converted")
+        nbytes = int(src.nbytes)
+        skip = 4
+    offsets = np.asarray(src.frame_indexes, dtype=np.int64) + skip
+    return offsets, dlens*(4 + nbytes), nbytes
+
+
+def _convert_range(src_name, dst_name, to, offsets, sizes, dlens, first,
+                   out_offset, aps_header, chunk_bytes):
+    ''' Copy the sparse blocks of a range of frames to their place in the
+        output file. This is run by the worker processes.
+    '''
+    src_fd = os.open(src_name, os.O_RDONLY)
+    dst_fd = os.open(dst_name, os.O_WRONLY)
+    try:
+        pieces = list()
+        nbuf = 0
+        for i in range(len(offsets)):
+            if to == 'aps':
+                aps_header['dlen'] = dlens[i]
+                aps_header['number'] = first + i
+                pieces.append(aps_header.tobytes())
+            else:
+                pieces.append(np.uint32(dlens[i]).tobytes())
+            pieces.append(os.pread(src_fd, int(sizes[i]), int(offsets[i])))
+            nbuf += len(pieces[-2]) + len(pieces[-1])
+            if nbuf >= chunk_bytes or i == len(offsets) - 1:
+                data = memoryview(b"".join(pieces))
+                while len(data):
+                    nwritten = os.pwrite(dst_fd, data, out_offset)
+                    out_offset += nwritten
+                    data = data[nwritten:]
+                pieces = list()
+                nbuf = 0
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+
+def convert(src, dst, to='bnl', workers=1, header=None,
+            chunk_bytes=64*1024*1024, write_index=False):
+    '''
+        Convert a multifile between the APS and BNL layouts.
+
+        Parameters
+        ----------
+        src : str
+            the input file, any layout understood by open_multifile
+        dst : str
+            the output file
+        to : {'bnl', 'aps'}, optional
+            the output layout
+        workers : int, optional
+            number of processes. The frames are split into this many
+            contiguous ranges.
+        header : dict, optional
+            values for the BNL main header (see pack_bnl_header), e.g.
+            beam center and pixel sizes, which APS files do not carry.
+            For BNL sources the source header is used by default.
+        chunk_bytes : int, optional
+            size of the writes of every process
+        write_index : bool, optional
+            append an index footer to BNL outputs. Readers that don't
+            know the footer take it for an extra frame.
+    '''
+    if to not in ('bnl', 'aps'):
+        raise ValueError("Error, to must be 'bnl' or 'aps', got : {}"
+                         .format(to))
+    mf = open_multifile(src)
+    offsets, sizes, nbytes = _record_layout(mf)
+    dlens = np.asarray(mf.dlens, dtype=np.int64)
+    rows, cols = mf.frame_shape
+    nframes = len(offsets)
+    mf.close()
+
+    aps_header = np.zeros(1, dtype=APS_HEADER_DTYPE)
+    if to == 'aps':
+        if nbytes not in (2, 4):
+            raise ValueError("Error, APS files store 2 or 4 byte values, "
+                             "got : {}".format(nbytes))
+        aps_header['compression'] = 6
+        aps_header['rows'] = rows
+        aps_header['cols'] = cols
+        aps_header['nbytes'] = nbytes
+        head = b""
+        record_sizes = APS_HEADER_DTYPE.itemsize + sizes
+    else:
+        md = dict(getattr(mf, 'md', {}))
+        if header is not None:
+            md.update(header)
+        md.update(nrows=rows, ncols=cols, bytes=nbytes)
+        md.update((key, 0) for key in BNL_EXT_HEADER_KEYS)
+        head = pack_bnl_header(md)
+        record_sizes = 4 + sizes
+    out_offsets = len(head) + np.concatenate([[0], np.cumsum(record_sizes)])
+
+    with open(dst, "wb") as fout:
+        fout.write(head)
+        fout.truncate(int(out_offsets[-1]))
+
+    bounds = np.linspace(0, nframes, max(workers, 1) + 1).astype(int)
+    jobs = [(src, dst, to, offsets[a:b], sizes[a:b], dlens[a:b], a,
+             int(out_offsets[a]), aps_header, chunk_bytes)
+            for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            for result in [pool.submit(_convert_range, *job)
+                           for job in jobs]:
+                result.result()
+    else:
+        for job in jobs:
+            _convert_range(*job)
+
+    if to == 'bnl' and write_index:
+        with open(dst, "ab") as fout:
+            fout.write(pack_bnl_footer(out_offsets[:-1], dlens))
@@ -1,5 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import logging
+import os
+import struct
+import time
+
 import numpy as np
 
+from .backends import open_backend
+from .cache import FrameCache
+from .codec import (BLOCK_HEADER_DTYPE, BLOCK_HEADER_SIZE, FRAME_TILED,
+                    RECORD_HEADER_DTYPE, RECORD_HEADER_SIZE, decode_dense,
+                    decode_frame, decode_split_frame, decode_tiles,
+                    decompress_block, tiles_of_roi)
+
 """    Description:
 
     This is code that Mark wrote to open the multifile format
@@ -25,177 +39,363 @@ import numpy as np
 
      Header contains 1024 bytes version name, 'beam_center_x', 'beam_center_y', 'count_time', 'detector_distance',
            'frame_time', 'incident_wavelength', 'x_pixel_size', 'y_pixel_size',
-           bytes per pixel (either 2 or 4 (Default)),
+           bytes per pixel (1, 2 or 4 (Default)),
            Nrows, Ncols, Rows_Begin, Rows_End, Cols_Begin, Cols_End,
 
+    Version-COMP0003 files have the same main header, but every frame
+    starts with a 12 byte record header (dlen, size, tag) and its payload
+    is encoded as given by tag (see codec.py).
+
+    Version-COMP0003 files can be stored in compressed blocks of
+    block_frames frames ('codec' header field, see codec.py). The frame
+    offsets are then offsets in the decompressed blocks, and the file
+    offsets of the blocks are stored before the index footer.
+
+    Version-COMP0003 files can carry tables (arrays) stored once, in npz
+    format, between the main header and the first frame ('tables_bytes'
+    header field). With a 'pixels' table, the positions stored in the
+    frames are ids of pixels, pixel id i being the detector position
+    pixels[i]. A 'source_frames' table holds the frame number in the
+    source of every stored frame, when only some of the source frames
+    were compressed.
+
+    Version-COMP0003 frames written with the tiled encoding group their
+    events by tiles of (tile_rows, tile_cols) pixels, so a region of a
+    frame is read from the tiles it overlaps only.
 
 
 """
 
-# TODO : split into RO and RW classes
-class MultifileAPS:
+logger = logging.getLogger(__name__)
+
+# The per-frame header of APS (IMM) files in compressed mode.
+APS_HEADER_DTYPE = np.dtype({
+    'names': ['mode', 'compression', 'date', 'prefix', 'number', 'suffix',
+              'monitor', 'shutter', 'row_beg', 'row_end', 'col_beg',
+              'col_end', 'row_bin', 'col_bin', 'rows', 'cols', 'nbytes',
+              'kinetics', 'kinwinsize', 'elapsed', 'preset', 'topup',
+              'inject', 'dlen', 'roi_number', 'buffer_number', 'systick'],
+    'formats': ['<i4', '<i4', 'S32', 'S16', '<i4', 'S16',
+                '<i4', '<i4', '<i4', '<i4', '<i4',
+                '<i4', '<i4', '<i4', '<i4', '<i4', '<i4',
+                '<i4', '<i4', '<f8', '<f8', '<i4',
+                '<i4', '<i4', '<i4', '<u4', '<u4'],
+    'offsets': [0, 4, 8, 40, 56, 60,
+                76, 80, 84, 88, 92,
+                96, 100, 104, 108, 112, 116,
+                120, 124, 128, 136, 144,
+                148, 152, 156, 160, 164],
+    'itemsize': 1024,
+})
+
+# The main header of BNL files: 16 byte magic, then these keys.
+# The keys after cols_end (BNL_EXT_HEADER_KEYS) are in what used to be
+# padding. They are only used in Version-COMP0003 files, and are 0 in
+# the others.
+BNL_HEADER_KEYS = ['beam_center_x', 'beam_center_y', 'count_time',
+                   'detector_distance', 'frame_time', 'incident_wavelength',
+                   'x_pixel_size', 'y_pixel_size', 'bytes', 'nrows', 'ncols',
+                   'rows_begin', 'rows_end', 'cols_begin', 'cols_end',
+                   'codec', 'block_frames', 'tables_bytes', 'tile_rows',
+                   'tile_cols']
+BNL_EXT_HEADER_KEYS = BNL_HEADER_KEYS[15:]
+BNL_HEADER_FORMAT = '@8d12I896x'
+BNL_MAGIC = b"Version-COMP0002"
+BNL_MAGIC_V3 = b"Version-COMP0003"
+
+# The optional index footer of BNL files, written by MultifileBNLWriter:
+#   <u8 frame_indexes[N], <u4 dlens[N], then the 16 byte trailer
+#   BNL_INDEX_MAGIC, <u8 N
+# Files in blocks have <u8 block_offsets[nblocks + 1] just before it, the
+# last one being the end of the last block.
+BNL_INDEX_MAGIC = b"BNLINDEX"
+BNL_INDEX_TRAILER = 16
+
+
+def pack_bnl_header(md, magic=BNL_MAGIC):
+    ''' Serialize a BNL main header from a dict.
+
+        Missing keys are written as 0, except 'bytes' (2) and the
+        rows/cols ranges which default to the full frame.
+    '''
+    md = dict(md)
+    md.setdefault('bytes', 2)
+    md.setdefault('rows_begin', 0)
+    md.setdefault('rows_end', md['nrows'])
+    md.setdefault('cols_begin', 0)
+    md.setdefault('cols_end', md['ncols'])
+    vals = [md.get(key, 0) for key in BNL_HEADER_KEYS]
+    return struct.pack('@16s', magic) + struct.pack(BNL_HEADER_FORMAT, *vals)
+
+
+def unpack_bnl_header(header):
+    ''' Return (magic, dict) of a serialized BNL main header.'''
+    magic, = struct.unpack('@16s', header[:16])
+    md = dict(zip(BNL_HEADER_KEYS, struct.unpack(BNL_HEADER_FORMAT,
+                                                 header[16:1024])))
+    return magic, md
+
+
+def pack_bnl_footer(frame_indexes, dlens):
+    ''' Serialize the index footer of a BNL file.'''
+    frame_indexes = np.asarray(frame_indexes, dtype="<u8")
+    dlens = np.asarray(dlens, dtype="<u4")
+    return (frame_indexes.tobytes() + dlens.tobytes() + BNL_INDEX_MAGIC
+            + struct.pack('<Q', len(frame_indexes)))
+
+
+def pack_bnl_tables(tables):
+    ''' Serialize the tables of a BNL file (a dict of arrays).'''
+    buf = io.BytesIO()
+    np.savez(buf, **tables)
+    return buf.getvalue()
+
+
+def _densify(pos, vals, shape, dtype=np.float64, roi=None):
+    ''' Make a dense image of the given shape from positions and values.
+
+        roi : tuple, optional
+            (rows_begin, rows_end, cols_begin, cols_end), only this region
+            of the image is returned
+    '''
+    rows, cols = shape
+    if roi is None:
+        img = np.zeros(rows*cols, dtype=dtype)
+        img[pos] = vals
+        return img.reshape(shape)
+    r0, r1, c0, c1 = roi
+    r, c = np.divmod(pos, cols)
+    w = (r >= r0) & (r < r1) & (c >= c0) & (c < c1)
+    img = np.zeros((r1 - r0, c1 - c0), dtype=dtype)
+    img[r[w] - r0, c[w] - c0] = vals[w]
+    return img
+
+
+def _make_cache(cache_bytes):
+    if cache_bytes:
+        return FrameCache(cache_bytes)
+    return None
+
+
+class MultifileBase:
+    '''
+        The interface shared by the multifile readers.
+
+        Subclasses fill in self.frame_indexes and self.Nframes in index(),
+        self.frame_shape, and decode one frame into (pos, vals) in
+        _read_raw(). Dense reads, caching and the I/O backend live here.
+    '''
+    HEADER_SIZE = 1024
+
+    def __init__(self, filename, cache_bytes=0, backend='mmap'):
+        '''
+            cache_bytes : int, optional
+                budget of the decoded frame cache used by rdframe.
+                0 (default) disables caching.
+
+            backend : str or callable, optional
+                the I/O backend used for reading: 'mmap', 'pread' or
+                'madvise' (see backends.py)
+        '''
+        self._filename = filename
+        self.cache = _make_cache(cache_bytes)
+        self._fd = open_backend(filename, backend)
+
+    def __len__(self):
+        return self.Nframes
+
+    def _check_frame(self, n):
+        if n >= self.Nframes:
+            raise KeyError("Error, only {} frames, asked for {}"
+                           .format(self.Nframes, n))
+
+    def rdframe(self, n, dtype=np.float64, roi=None):
+        ''' Read frame n as a dense image.
+
+            dtype : the dtype of the image
+            roi : (rows_begin, rows_end, cols_begin, cols_end), optional
+                only return this region
+
+            When the cache is enabled, the returned images are read-only.
+        '''
+        key = (n, np.dtype(dtype).str, roi)
+        if self.cache is not None:
+            img = self.cache.get(key)
+            if img is not None:
+                return img
+        img = self._read_dense(n, dtype, roi)
+        if self.cache is not None:
+            img.flags.writeable = False
+            self.cache.put(key, img)
+        return img
+
+    def _read_dense(self, n, dtype, roi):
+        ''' Read frame n as a dense image, not cached.'''
+        pos, vals = self._read_raw(n)
+        return _densify(pos, vals, self.frame_shape, dtype=dtype, roi=roi)
+
+    def rdrawframe(self, n):
+        ''' Read frame n as (pos, vals).'''
+        return self._read_raw(n)
+
+    def _pin_frames(self, ns, workers):
+        ''' Load what the frames ns need before a batch read.'''
+        pass
+
+    def _unpin(self):
+        pass
+
+    def rdrawframes(self, ns, workers=4):
+        ''' Read a batch of frames as a list of (pos, vals).
+
+            workers : threads used to prepare the batch, e.g. decompress
+                the blocks of files in blocks
+        '''
+        self._pin_frames(np.asarray(ns, dtype=np.int64), workers)
+        try:
+            return [self.rdrawframe(int(n)) for n in ns]
+        finally:
+            self._unpin()
+
+    def rdframes(self, ns, dtype=np.float64, roi=None, workers=4):
+        ''' Read a batch of frames as a 3D array.'''
+        self._pin_frames(np.asarray(ns, dtype=np.int64), workers)
+        try:
+            frames = [self.rdframe(int(n), dtype=dtype, roi=roi) for n in ns]
+        finally:
+            self._unpin()
+        if not frames:
+            if roi is None:
+                return np.empty((0,) + tuple(self.frame_shape), dtype=dtype)
+            return np.empty((0, roi[1] - roi[0], roi[3] - roi[2]),
+                            dtype=dtype)
+        return np.array(frames)
+
+    def rdsplitframe(self, n):
+        ''' Read frame n as (ones, pos, vals): the positions of the single
+            photon events, and the events with more counts.
+        '''
+        pos, vals = self._read_raw(n)
+        w = vals == 1
+        return pos[w], pos[~w], vals[~w]
+
+    def close(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+
+class MultifileAPS(MultifileBase):
     '''
     Re-write multifile from scratch.
 
     '''
     HEADER_SIZE = 1024
-    def __init__(self, filename, mode='rb', nbytes=2):
+    def __init__(self, filename, mode='rb', nbytes=2, cache_bytes=0,
+                 backend='mmap'):
         '''
-            Prepare a file for reading or writing.
-            mode : either 'rb' or 'wb'
-            numimgs: num images
+            Prepare a file for reading.
+            mode : only 'rb', see writer.MultifileAPSWriter for writing
+            nbytes : bytes per value, used if the frame headers do not say
+            cache_bytes : int, optional
+                budget of the decoded frame cache used by rdframe.
+                0 (default) disables caching.
+            backend : str or callable, optional
+                the I/O backend used for reading: 'mmap', 'pread' or
+                'madvise' (see backends.py)
         '''
+        if mode == 'wb':
+            raise ValueError("Write mode 'wb' not supported, use "
+                             "writer.MultifileAPSWriter")
         if mode != 'rb' and mode != 'wb':
             raise ValueError("Error, mode must be 'rb' or 'wb'"
                              "got : {}".format(mode))
-        self._filename = filename
         self._mode = mode
 
+        # bytes per value, if the frame headers do not say
         self._nbytes = nbytes
-        if nbytes == 2:
-            self._dtype = '<i2'
-        elif nbytes == 4:
-            self._dtype = '<i4'
-
-
-        # open the file descriptor
-        # create a memmap
-        if mode == 'rb':
-            self._fd = np.memmap(filename, dtype='c')
-        elif mode == 'wb':
-            self._fd = open(filename, "wb")
+
+        super().__init__(filename, cache_bytes=cache_bytes, backend=backend)
         # frame number currently on
         self.index()
         self.beg = 0
         self.end = self.Nframes-1
 
-        # these are only necessary for writing
-        hdr = self._read_header(0)
-        self._rows = int(hdr['rows'])
-        self._cols = int(hdr['cols'])
-
-    def rdframe(self, n):
-        # read header then image
-        hdr = self._read_header(n)
-        pos, vals = self._read_raw(n)
-        img = np.zeros((self._rows*self._cols,))
-        img[pos] = vals
-        return img.reshape((self._rows, self._cols))
-
-    def rdrawframe(self, n):
-        # read header then image
-        hdr = self._read_header(n)
-        return self._read_raw(n)
-
-    def rdchunk(self):
-        ''' read the next chunk'''
-        header = self._fd.read(1024)
+        self._rows = int(self.headers['rows'][0])
+        self._cols = int(self.headers['cols'][0])
+        self.frame_shape = (self._rows, self._cols)
 
     def index(self):
         ''' Index the file by reading all frame_indexes.
             For faster later access.
+
+            The per-frame headers are parsed once into self.headers, a
+            structured array (see APS_HEADER_DTYPE). Reads only use this
+            table.
         '''
-        print('Indexing file...')
+        logger.info("Indexing file %s", self._filename)
         t1 = time.time()
         cur = 0
         file_bytes = len(self._fd)
 
         self.frame_indexes = list()
+        headers = list()
         while cur < file_bytes:
             self.frame_indexes.append(cur)
-            # first get dlen, 4 bytes
-            dlen = np.frombuffer(self._fd[cur+152:cur+156], dtype="<u4")[0]
-            print("found {} bytes".format(dlen))
-            # self.nbytes is number of bytes per val
-            cur += 1024 + dlen*(4+self._nbytes)
-            #break
-
+            header_raw = bytes(self._fd[cur:cur + self.HEADER_SIZE])
+            headers.append(header_raw)
+            # dlen at 152 and bytes per value at 116, 4 bytes each
+            dlen, = struct.unpack('<i', header_raw[152:156])
+            nbytes, = struct.unpack('<i', header_raw[116:120])
+            if nbytes not in (2, 4):
+                nbytes = self._nbytes
+            cur += self.HEADER_SIZE + dlen*(4+nbytes)
+
+        self.headers = np.frombuffer(b"".join(headers),
+                                     dtype=APS_HEADER_DTYPE)
+        self.frame_indexes = np.array(self.frame_indexes, dtype=np.int64)
+        self.dlens = self.headers['dlen'].astype(np.uint32)
+        nbytes = self.headers['nbytes']
+        self._frame_nbytes = np.where((nbytes == 2) | (nbytes == 4), nbytes,
+                                      self._nbytes)
         self.Nframes = len(self.frame_indexes)
         t2 = time.time()
-        print("Done. Took {} secs for {} frames".format(t2-t1, self.Nframes))
-
-
+        logger.info("Done. Took %s secs for %s frames", t2-t1, self.Nframes)
 
     def _read_header(self, n):
-        ''' Read header from current seek position.'''
-        if n > self.Nframes:
-            raise KeyError("Error, only {} frames, asked for {}".format(self.Nframes, n))
-        # read in bytes
-        cur = self.frame_indexes[n]
-        header_raw = self._fd[cur:cur + self.HEADER_SIZE]
-        header = dict()
-        header['rows'] = np.frombuffer(header_raw[108:112], dtype=self._dtype)[0]
-        header['cols'] = np.frombuffer(header_raw[112:116], dtype=self._dtype)[0]
-        header['nbytes'] = np.frombuffer(header_raw[116:120], dtype=self._dtype)[0]
-        header['dlen'] = np.frombuffer(header_raw[152:156], dtype=self._dtype)[0]
-        #print("dlen: {}\trows: {}\tcols: {}\tnbytes: {}\n"\
-              #.format(header['dlen'], header['rows'], header['cols'],
-                      #header['nbytes']))
-
-        self._dlen = header['dlen']
-        self._nbytes = header['nbytes']
-
-        return header
+        ''' Return the header of frame n as a dict.'''
+        self._check_frame(n)
+        row = self.headers[n]
+        return {name: row[name] for name in APS_HEADER_DTYPE.names}
 
     def _read_raw(self, n):
         ''' Read from raw.
             Reads from current cursor in file.
         '''
-        if n > self.Nframes:
-            raise KeyError("Error, only {} frames, asked for {}".format(self.Nframes, n))
-        cur = self.frame_indexes[n] + 1024
-        dlen = self._read_header(n)['dlen']
+        self._check_frame(n)
+        dlen = int(self.dlens[n])
+        nbytes = int(self._frame_nbytes[n])
+        cur = int(self.frame_indexes[n]) + self.HEADER_SIZE
 
         pos = self._fd[cur: cur+dlen*4]
         cur += dlen*4
         pos = np.frombuffer(pos, dtype='<i4')
 
-        # TODO: 2-> nbytes
-        vals = self._fd[cur: cur+dlen*2]
-        # not necessary
-        cur += dlen*2
-        vals = np.frombuffer(vals, dtype=self._dtype)
+        vals = self._fd[cur: cur+dlen*nbytes]
+        vals = np.frombuffer(vals, dtype='<i{}'.format(nbytes))
 
         return pos, vals
 
-    def _write_header(self, dlen, rows, cols):
-        ''' Write header at current position.'''
-        self._rows = rows
-        self._cols = cols
-        self._dlen = dlen
-        # byte array
-        header = np.zeros(self.HEADER_SIZE, dtype="c")
-        # write the header dlen
-        header[152:156] = np.array([dlen], dtype="<i4").tobytes()
-        # rows
-        header[108:112] = np.array([rows], dtype="<i4").tobytes()
-        # colds
-        header[112:116] = np.array([cols], dtype="<i4").tobytes()
-        self._fd.write(header)
-
-
-    def write_raw(self, pos, vals):
-        ''' Write a raw set of values for the next chunk.'''
-        rows = self._rows
-        cols = self._cols
-        dlen = len(pos)
-        self._write_header(dlen, rows, cols)
-        # now write the pos and vals in series
-        pos = pos.astype(self._dtype)
-        vals = vals.astype(self._dtype)
-        self._fd.write(pos)
-        self._fd.write(vals)
 
-import struct
-import time
-# TODO : split into RO and RW classes
-class MultifileBNL:
+class MultifileBNL(MultifileBase):
     '''
     Re-write multifile from scratch.
 
     '''
     HEADER_SIZE = 1024
-    def __init__(self, filename, mode='rb', version=2):
+    def __init__(self, filename, mode='rb', version=2, frame_indexes=None,
+                 dlens=None, cache_bytes=0, backend='mmap',
+                 block_offsets=None, block_cache_bytes=64*1024*1024):
         '''
             Prepare a file for reading or writing.
             mode : either 'rb' or 'wb'
@@ -203,6 +403,26 @@ class MultifileBNL:
             version : int, optional
                 version 1 is old bnl format
                 version 2 is the new format
+
+            frame_indexes, dlens : array-like, optional
+                a precomputed index (e.g. attached from a SharedIndex).
+                If given, the file is not scanned again.
+
+            cache_bytes : int, optional
+                budget of the decoded frame cache used by rdframe.
+                0 (default) disables caching.
+
+            backend : str or callable, optional
+                the I/O backend used for reading: 'mmap', 'pread' or
+                'madvise' (see backends.py)
+
+            block_offsets : array-like, optional
+                the precomputed block offsets of files in blocks, with
+                frame_indexes and dlens
+
+            block_cache_bytes : int, optional
+                budget of the cache of decompressed blocks, for files in
+                blocks
         '''
         self._version = version
         if mode == 'wb':
@@ -212,60 +432,350 @@ class MultifileBNL:
             raise ValueError("Error, mode must be 'rb' or 'wb'"
                              "got : {}".format(mode))
 
-        self._filename = filename
         self._mode = mode
-
-        # open the file descriptor
-        # create a memmap
-        if mode == 'rb':
-            self._fd = np.memmap(filename, dtype='c')
-        elif mode == 'wb':
-            self._fd = open(filename, "wb")
+        super().__init__(filename, cache_bytes=cache_bytes, backend=backend)
 
         # these are only necessary for writing
         self.md = self._read_main_header()
         self._rows = int(self.md['nrows'])
         self._cols = int(self.md['ncols'])
+        # trying to retain backwards compatibility of the old file
+        if self._version > 1:
+            self.frame_shape = (self._rows, self._cols)
+        else:
+            self.frame_shape = (self._cols, self._rows)
 
         # some initialization stuff
         self.nbytes = self.md['bytes']
-        if (self.nbytes==2):
-            self.valtype = "<i2"#np.uint16
+        if (self.nbytes == 1):
+            self.valtype = "<u1"#np.uint8
+        elif (self.nbytes==2):
+            self.valtype = "<u2"#np.uint16
         elif (self.nbytes == 4):
-            self.valtype = "<i4"#np.uint32
+            self.valtype = "<u4"#np.uint32
         elif (self.nbytes == 8):
             self.valtype = "<i8"#np.float64
 
+        # Version-COMP0003 frames are encoded, with a record header
+        self._encoded = self.magic == BNL_MAGIC_V3
+        # only they use the header fields in the old padding
+        self._extended = self._version > 1 and self._encoded
+
+        # the block container
+        self.codec = int(self.md['codec']) if self._extended else 0
+        self.block_frames = int(self.md['block_frames'])
+        self.block_offsets = None
+        self.block_cache = _make_cache(block_cache_bytes if self.codec
+                                       else 0)
+        self._pinned = None
+
+        # the tables, then the frames
+        self.tables = self._read_tables()
+        self._data_start = self.HEADER_SIZE + self._tables_bytes
+        self._pixels = self.tables.get('pixels')
+        # the shape the stored positions refer to
+        self._id_shape = self.frame_shape
+        if self._pixels is not None:
+            self._id_shape = (1, len(self._pixels))
+        self.tile_shape = None
+        if self._extended and self.md['tile_rows']:
+            self.tile_shape = (int(self.md['tile_rows']),
+                               int(self.md['tile_cols']))
+        self.partition_labels = self.tables.get('partition_labels')
+        self.partition_bounds = self.tables.get('partition_bounds')
+        self.source_frames = self.tables.get('source_frames')
 
         # frame number currently on
-        self.index()
-
-    def __len__(self):
-        return self.Nframes
+        if frame_indexes is None or (self.codec and block_offsets is None):
+            self.index()
+        else:
+            self.frame_indexes = frame_indexes
+            self.dlens = dlens
+            self.Nframes = len(frame_indexes)
+            if self.codec:
+                self.block_offsets = block_offsets
 
     def index(self):
         ''' Index the file by reading all frame_indexes.
             For faster later access.
+
+            If the file ends with an index footer, it is used instead of
+            walking through the frames.
         '''
-        print('Indexing file...')
+        logger.info("Indexing file %s", self._filename)
         t1 = time.time()
-        cur = self.HEADER_SIZE
+        if self._read_footer():
+            t2 = time.time()
+            logger.info("Done. Read index footer in %s secs for %s frames",
+                        t2-t1, self.Nframes)
+            return
+        cur = self._data_start
         file_bytes = len(self._fd)
 
         self.frame_indexes = list()
-        while cur < file_bytes:
-            self.frame_indexes.append(cur)
-            # first get dlen, 4 bytes
-            dlen = np.frombuffer(self._fd[cur:cur+4], dtype="<u4")[0]
-            #print("found {} bytes".format(dlen))
-            # self.nbytes is number of bytes per val
-            cur += 4 + dlen*(4+self.nbytes)
-            #break
-
+        self.dlens = list()
+        if self.codec:
+            self._index_blocks()
+        else:
+            while cur < file_bytes:
+                dlen, end = self._record_end(cur)
+                if end > file_bytes:
+                    # a record cut by an interrupted write
+                    logger.warning("Truncated frame at %s of %s", cur,
+                                   self._filename)
+                    break
+                self.frame_indexes.append(cur)
+                self.dlens.append(dlen)
+                cur = end
+
+        self.frame_indexes = np.array(self.frame_indexes, dtype=np.int64)
+        self.dlens = np.array(self.dlens, dtype=np.uint32)
         self.Nframes = len(self.frame_indexes)
         t2 = time.time()
-        print("Done. Took {} secs for {} frames".format(t2-t1, self.Nframes))
+        logger.info("Done. Took %s secs for %s frames", t2-t1, self.Nframes)
 
+    def _index_blocks(self):
+        ''' Walk through the blocks, decompressing them to find the
+            frames. Stops at the first block that is truncated or can't
+            be decompressed.
+        '''
+        cur = self._data_start
+        file_bytes = len(self._fd)
+        block_offsets = list()
+        while cur + BLOCK_HEADER_SIZE <= file_bytes:
+            size, nframes = np.frombuffer(self._fd[cur:cur+BLOCK_HEADER_SIZE],
+                                          dtype=BLOCK_HEADER_DTYPE)[0]
+            end = cur + BLOCK_HEADER_SIZE + int(size)
+            if end > file_bytes:
+                break
+            try:
+                block = decompress_block(
+                    bytes(self._fd[cur+BLOCK_HEADER_SIZE:end]), self.codec)
+            except Exception:
+                logger.warning("Could not decompress block at %s of %s",
+                               cur, self._filename)
+                break
+            block_offsets.append(cur)
+            start = 0
+            for i in range(int(nframes)):
+                self.frame_indexes.append(start)
+                dlen, start = self._record_end(start, block)
+                self.dlens.append(dlen)
+            cur = end
+        block_offsets.append(cur)
+        self.block_offsets = np.array(block_offsets, dtype=np.int64)
+
+    def _read_footer(self):
+        ''' Read the index footer, if the file has a valid one.
+
+            Returns True if the index was read from the footer.
+        '''
+        file_bytes = len(self._fd)
+        if file_bytes < self._data_start + BNL_INDEX_TRAILER:
+            return False
+        trailer = bytes(self._fd[file_bytes - BNL_INDEX_TRAILER:file_bytes])
+        if trailer[:8] != BNL_INDEX_MAGIC:
+            return False
+        nframes, = struct.unpack('<Q', trailer[8:])
+        footer_start = file_bytes - BNL_INDEX_TRAILER - 12*nframes
+        if footer_start < self._data_start:
+            return False
+        frame_indexes = np.frombuffer(
+            self._fd[footer_start:footer_start + 8*nframes], dtype="<u8")
+        dlens = np.frombuffer(
+            self._fd[footer_start + 8*nframes:footer_start + 12*nframes],
+            dtype="<u4")
+        if self.codec:
+            # the block offsets are just before, the last one is where
+            # they start
+            nblocks = -(-nframes // max(self.block_frames, 1))
+            table_start = footer_start - 8*(nblocks + 1)
+            if table_start < self._data_start:
+                return False
+            block_offsets = np.frombuffer(
+                self._fd[table_start:footer_start], dtype="<u8")
+            if int(block_offsets[-1]) != table_start:
+                return False
+            self.block_offsets = block_offsets.astype(np.int64)
+        else:
+            # the last frame must end where the footer starts
+            if nframes > 0:
+                _, end = self._record_end(int(frame_indexes[-1]))
+            else:
+                end = self._data_start
+            if end != footer_start:
+                return False
+        self.frame_indexes = frame_indexes.astype(np.int64)
+        self.dlens = dlens.astype(np.uint32)
+        self.Nframes = len(self.frame_indexes)
+        return True
+
+    def _record_end(self, cur, buf=None):
+        ''' Return (dlen, end offset) of the frame starting at cur of buf
+            (the file by default).
+        '''
+        if buf is None:
+            buf = self._fd
+        if self._encoded:
+            dlen, size, tag = np.frombuffer(
+                buf[cur:cur+RECORD_HEADER_SIZE],
+                dtype=RECORD_HEADER_DTYPE)[0]
+            return int(dlen), cur + RECORD_HEADER_SIZE + int(size)
+        # first get dlen, 4 bytes
+        dlen = int(np.frombuffer(buf[cur:cur+4], dtype="<u4")[0])
+        # self.nbytes is number of bytes per val
+        return dlen, cur + 4 + dlen*(4+self.nbytes)
+
+    def _read_block_data(self, nblock):
+        ''' Return the compressed bytes of block nblock.'''
+        cur = int(self.block_offsets[nblock])
+        size = int(np.frombuffer(self._fd[cur:cur+BLOCK_HEADER_SIZE],
+                                 dtype=BLOCK_HEADER_DTYPE)[0]['size'])
+        cur += BLOCK_HEADER_SIZE
+        return bytes(self._fd[cur:cur+size])
+
+    def _decompress_block(self, nblock):
+        return decompress_block(self._read_block_data(nblock), self.codec)
+
+    def _read_block(self, nblock):
+        ''' Return the decompressed block nblock, through the block cache.
+        '''
+        if self._pinned is not None and nblock in self._pinned:
+            return self._pinned[nblock]
+        if self.block_cache is not None:
+            block = self.block_cache.get(nblock)
+            if block is not None:
+                return block
+        block = self._decompress_block(nblock)
+        if self.block_cache is not None:
+            self.block_cache.put(nblock, block)
+        return block
+
+    def _frame_buffer(self, n):
+        ''' Return (buffer, offset) of frame n, the buffer being the file
+            or the decompressed block holding the frame.
+        '''
+        if self.codec:
+            return (self._read_block(n // self.block_frames),
+                    int(self.frame_indexes[n]))
+        return self._fd, int(self.frame_indexes[n])
+
+    def _pin_frames(self, ns, workers):
+        ''' Decompress the blocks of the frames ns in parallel, they are
+            kept until _unpin.
+        '''
+        # bad frame numbers are left to the reads to report
+        ns = ns[(ns >= 0) & (ns < self.Nframes)]
+        if not self.codec or len(ns) == 0:
+            return
+        nblocks = [int(b) for b in np.unique(ns // self.block_frames)
+                   if self.block_cache is None or b not in self.block_cache]
+        if workers > 1 and len(nblocks) > 1:
+            # the backends are not thread safe, the blocks are read here
+            # and only decompressed in the threads (zlib and lzma release
+            # the GIL while decompressing)
+            data = [self._read_block_data(b) for b in nblocks]
+            with ThreadPoolExecutor(workers) as pool:
+                blocks = list(pool.map(decompress_block, data,
+                                       [self.codec]*len(data)))
+        else:
+            blocks = [self._decompress_block(b) for b in nblocks]
+        self._pinned = dict(zip(nblocks, blocks))
+        if self.block_cache is not None:
+            for nblock, block in self._pinned.items():
+                self.block_cache.put(nblock, block)
+
+    def _unpin(self):
+        self._pinned = None
+
+    def _record_at(self, n):
+        ''' Return (tag, buffer, payload offset, size, dlen) of the
+            encoded frame n.
+        '''
+        buf, cur = self._frame_buffer(n)
+        dlen, size, tag = np.frombuffer(buf[cur:cur+RECORD_HEADER_SIZE],
+                                        dtype=RECORD_HEADER_DTYPE)[0]
+        return int(tag), buf, cur + RECORD_HEADER_SIZE, int(size), int(dlen)
+
+    def _read_record(self, n):
+        ''' Return (tag, payload, dlen) of the encoded frame n.'''
+        tag, buf, cur, size, dlen = self._record_at(n)
+        return tag, buf[cur:cur+size], dlen
+
+    def rdsplitframe(self, n):
+        ''' Read frame n as (ones, pos, vals): the positions of the single
+            photon events, and the events with more counts.
+
+            Frames written with the 'ones' encoding are not merged, so
+            this is cheaper than rdrawframe for them.
+        '''
+        if not self._encoded:
+            return super().rdsplitframe(n)
+        self._check_frame(n)
+        tag, payload, dlen = self._read_record(n)
+        ones, pos, vals = decode_split_frame(tag, payload, dlen, self.valtype,
+                                             shape=self._id_shape,
+                                             tile_shape=self.tile_shape)
+        if self._pixels is not None:
+            ones, pos = self._pixels[ones], self._pixels[pos]
+        return ones, pos, vals
+
+    def _read_dense(self, n, dtype, roi):
+        ''' Frames stored dense are copied into the image, without going
+            through positions.
+        '''
+        if not self._encoded or self._pixels is not None:
+            return super()._read_dense(n, dtype, roi)
+        self._check_frame(n)
+        tag, buf, cur, size, dlen = self._record_at(n)
+        if tag == FRAME_TILED:
+            # only the tiles overlapping the roi are read
+            tiles = None
+            if roi is not None:
+                tiles = tiles_of_roi(roi, self.frame_shape, self.tile_shape)
+            pos, vals = decode_tiles(lambda a, b: buf[cur+a:cur+b],
+                                     self.valtype, self.frame_shape,
+                                     self.tile_shape, tiles)
+            return _densify(pos, vals, self.frame_shape, dtype=dtype,
+                            roi=roi)
+        payload = buf[cur:cur+size]
+        dense = decode_dense(tag, payload, self.valtype, self.frame_shape)
+        if dense is None:
+            pos, vals = decode_frame(tag, payload, dlen, self.valtype,
+                                     shape=self.frame_shape)
+            return _densify(pos, vals, self.frame_shape, dtype=dtype,
+                            roi=roi)
+        (r0, r1, c0, c1), vals = dense
+        if roi is None:
+            roi = (0, self.frame_shape[0], 0, self.frame_shape[1])
+        img = np.zeros((roi[1] - roi[0], roi[3] - roi[2]), dtype=dtype)
+        # the part of the stored box inside the roi
+        rb, re = max(r0, roi[0]), min(r1, roi[1])
+        cb, ce = max(c0, roi[2]), min(c1, roi[3])
+        if rb < re and cb < ce:
+            img[rb - roi[0]:re - roi[0], cb - roi[2]:ce - roi[2]] = \
+                vals[rb - r0:re - r0, cb - c0:ce - c0]
+        return img
+
+    def close(self):
+        # the index may be a view of a SharedIndex, which can only be
+        # closed once no view of it is left
+        self.frame_indexes = None
+        self.dlens = None
+        self.block_offsets = None
+        super().close()
+
+    def _read_tables(self):
+        ''' Read the tables stored after the main header, if any.'''
+        self._tables_bytes = 0
+        if self._extended:
+            self._tables_bytes = int(self.md['tables_bytes'])
+        if not self._tables_bytes:
+            return dict()
+        raw = bytes(self._fd[self.HEADER_SIZE:
+                             self.HEADER_SIZE + self._tables_bytes])
+        with np.load(io.BytesIO(raw), allow_pickle=False) as npz:
+            return {key: npz[key] for key in npz.files}
 
     def _read_main_header(self):
         ''' Read header from current seek position.
@@ -282,73 +792,216 @@ class MultifileBNL:
         # read in bytes
         # header is always from zero
         cur = 0
-        header_raw = self._fd[cur:cur + self.HEADER_SIZE]
-        ms_keys = ['beam_center_x', 'beam_center_y', 'count_time',
-                   'detector_distance', 'frame_time', 'incident_wavelength',
-                   'x_pixel_size', 'y_pixel_size', 'bytes', 'nrows', 'ncols',
-                   'rows_begin', 'rows_end', 'cols_begin', 'cols_end']
-        magic = struct.unpack('@16s', header_raw[:16])
-        md_temp =  struct.unpack('@8d7I916x', header_raw[16:])
-        self.md = dict(zip(ms_keys, md_temp))
+        header_raw = bytes(self._fd[cur:cur + self.HEADER_SIZE])
+        self.magic, self.md = unpack_bnl_header(header_raw)
         return self.md
 
     def _read_raw(self, n):
         ''' Read from raw.
             Reads from current cursor in file.
         '''
-        if n > self.Nframes:
-            raise KeyError("Error, only {} frames, asked for {}".format(self.Nframes, n))
+        pos, vals = self._read_ids(n)
+        if self._pixels is not None:
+            pos = self._pixels[pos]
+        return pos, vals
+
+    def rdpartframe(self, n):
+        ''' Read frame n of a partition sorted file as (bounds, ids, vals).
+
+            The events of partition partition_labels[i] are
+            ids[bounds[i]:bounds[i+1]] (and the same part of vals), the
+            detector positions of the ids are pixels[ids].
+        '''
+        if self.partition_bounds is None:
+            raise ValueError("Error, {} is not partition sorted"
+                             .format(self._filename))
+        ids, vals = self._read_ids(n)
+        return np.searchsorted(ids, self.partition_bounds), ids, vals
+
+    def _read_ids(self, n):
+        ''' Read frame n as stored, (pixel ids or positions, vals).'''
+        self._check_frame(n)
+        if self._encoded:
+            tag, payload, dlen = self._read_record(n)
+            return decode_frame(tag, payload, dlen, self.valtype,
+                                shape=self._id_shape,
+                                tile_shape=self.tile_shape)
+        buf, cur = self._frame_buffer(n)
         # dlen is 4 bytes
-        cur = self.frame_indexes[n]
-        dlen = np.frombuffer(self._fd[cur:cur+4], dtype="<u4")[0]
+        dlen = int(np.frombuffer(buf[cur:cur+4], dtype="<u4")[0])
         cur += 4
 
-        pos = self._fd[cur: cur+dlen*4]
+        pos = buf[cur: cur+dlen*4]
         cur += dlen*4
         pos = np.frombuffer(pos, dtype='<u4')
 
-        # TODO: 2-> nbytes
-        vals = self._fd[cur: cur+dlen*self.nbytes]
+        vals = buf[cur: cur+dlen*self.nbytes]
         vals = np.frombuffer(vals, dtype=self.valtype)
 
         return pos, vals
 
-    def rdframe(self, n):
-        # read header then image
-        pos, vals = self._read_raw(n)
-        img = np.zeros((self._rows*self._cols,))
-        img[pos] = vals
-        # trying to retain backwards compatibility of the old file
-        if self._version > 1:
-            img = img.reshape((self._rows, self._cols))
-        else:
-            img = img.reshape((self._cols, self._rows))
-        return img
-
-    def rdrawframe(self, n):
-        # read header then image
-        return self._read_raw(n)
-
 
 class MultifileBNLCustom(MultifileBNL):
-    def __init__(self, filename, beg=0, end=None, reverse=True, **kwargs):
+    '''
+        A MultifileBNL with a frame offset and geometric transforms.
+
+        Parameters
+        ----------
+        beg, end : int, optional
+            frame n is read from frame n - beg of the file, and frames
+            after end can't be read
+        reverse : bool, optional
+            flip the rows of the frames (same as transforms=['flipud'])
+        transforms : list, optional
+            transforms applied in order, each one of
+                'crop'      : keep rows_begin:rows_end, cols_begin:cols_end
+                              of the header
+                ('crop', (rows_begin, rows_end, cols_begin, cols_end))
+                'transpose'
+                'flipud', 'fliplr'
+                'rot90', ('rot90', k) : rotate by k*90 degrees (as np.rot90)
+
+        The transforms are done on the sparse positions, through a lookup
+        table computed once. rdrawframe and rdframe agree, and cost one
+        integer gather instead of a copy of the dense frame. The positions
+        returned by rdrawframe are not sorted anymore.
+    '''
+    def __init__(self, filename, beg=0, end=None, reverse=True,
+                 transforms=None, **kwargs):
         super().__init__(filename, **kwargs)
         self.beg = beg
         if end is None:
             end = self.Nframes-1
         self.end = end
         self.reverse = reverse
+        transforms = list(transforms or [])
+        if reverse:
+            transforms.append('flipud')
+        self.transforms = transforms
+        self._make_lut()
+
+    def _make_lut(self):
+        ''' Compute the new position of every position of the file.'''
+        self._lut = None
+        self._cropped = False
+        if not self.transforms:
+            return
+        # the image of the original positions, transformed like a frame
+        img = np.arange(self.frame_shape[0]*self.frame_shape[1],
+                        dtype=np.int64).reshape(self.frame_shape)
+        for transform in self.transforms:
+            name, arg = transform, None
+            if not isinstance(transform, str):
+                name, arg = transform
+            if name == 'crop':
+                if arg is None:
+                    arg = (self.md['rows_begin'], self.md['rows_end'],
+                           self.md['cols_begin'], self.md['cols_end'])
+                r0, r1, c0, c1 = arg
+                img = img[r0:r1, c0:c1]
+                self._cropped = True
+            elif name == 'transpose':
+                img = img.T
+            elif name == 'flipud':
+                img = img[::-1]
+            elif name == 'fliplr':
+                img = img[:, ::-1]
+            elif name == 'rot90':
+                img = np.rot90(img, 1 if arg is None else arg)
+            else:
+                raise ValueError("Error, unknown transform : {}"
+                                 .format(transform))
+        lut = np.full(self.frame_shape[0]*self.frame_shape[1], -1,
+                      dtype=np.int64)
+        lut[img.ravel()] = np.arange(img.size)
+        self._lut = lut
+        self.frame_shape = img.shape
+
+    def _read_raw(self, n):
+        pos, vals = super()._read_raw(n)
+        if self._lut is None:
+            return pos, vals
+        pos = self._lut[pos]
+        if self._cropped:
+            w = pos >= 0
+            pos, vals = pos[w], vals[w]
+        return pos, vals
 
-    def rdframe(self, n):
-        if n > self.end:
+    # the transforms are applied in _read_raw
+    _read_dense = MultifileBase._read_dense
+
+    def _pin_frames(self, ns, workers):
+        super()._pin_frames(ns - self.beg, workers)
+
+    def _file_frame(self, n):
+        ''' The frame of the file read for frame n.'''
+        if n < self.beg or n > self.end:
             raise IndexError("Index out of range")
-        if self.reverse:
-            return super().rdframe(n - self.beg)[::-1]
-        else:
-            return super().rdframe(n - self.beg) 
+        return n - self.beg
+
+    def rdframe(self, n, **kwargs):
+        return super().rdframe(self._file_frame(n), **kwargs)
 
     def rdrawframe(self, n):
-        if self.reverse:
-            return super().rdrawframe(n - self.beg)[::-1]
-        else:
-            return super().rdrawframe(n - self.beg)
+        return super().rdrawframe(self._file_frame(n))
+
+    def rdsplitframe(self, n):
+        return MultifileBase.rdsplitframe(self, self._file_frame(n))
+
+
+def _plausible_frame(nbytes, rows, cols, dlen):
+    return (nbytes in (1, 2, 4, 8) and 0 < rows < 1 << 16 and 0 < cols < 1 << 16
+            and dlen <= rows*cols)
+
+
+def sniff_format(filename):
+    ''' Guess the layout of a multifile from its first bytes.
+
+        Returns
+        -------
+        fmt : str
+            'bnl' for BNL files with a Version-COMP magic,
+            'aps' for APS files (a 1024 byte header per frame),
+            'bnl_v1' for the old BNL layout (no magic, transposed frames)
+    '''
+    file_bytes = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        head = f.read(1028)
+    if head[:12] == b"Version-COMP":
+        return 'bnl'
+    if len(head) >= 156:
+        # APS: rows, cols, nbytes at 108, dlen at 152 of every frame header
+        rows, cols, nbytes = struct.unpack('<3i', head[108:120])
+        dlen, = struct.unpack('<i', head[152:156])
+        if (_plausible_frame(nbytes, rows, cols, dlen)
+                and 1024 + dlen*(4 + nbytes) <= file_bytes):
+            return 'aps'
+    if len(head) >= 1028:
+        # old BNL: the main header without magic, then dlen at 1024
+        nbytes, rows, cols = struct.unpack('@3I', head[80:92])
+        dlen, = struct.unpack('<I', head[1024:1028])
+        if (_plausible_frame(nbytes, rows, cols, dlen)
+                and 1028 + dlen*(4 + nbytes) <= file_bytes):
+            return 'bnl_v1'
+    raise ValueError("Error, could not recognize the multifile format "
+                     "of {}".format(filename))
+
+
+def open_multifile(filename, **kwargs):
+    ''' Open a multifile of any known layout for reading.
+
+        The layout is sniffed from the file (see sniff_format) and the
+        matching reader is returned. All readers share the MultifileBase
+        interface (len, rdframe, rdrawframe, cache and I/O backend).
+
+        Parameters
+        ----------
+        filename : str
+        **kwargs : passed to the reader, e.g. cache_bytes or backend
+    '''
+    fmt = sniff_format(filename)
+    if fmt == 'aps':
+        return MultifileAPS(filename, **kwargs)
+    elif fmt == 'bnl_v1':
+        return MultifileBNL(filename, version=1, **kwargs)
+    return MultifileBNL(filename, **kwargs)
@@ -0,0 +1,147 @@
+'''
+Several BNL multifiles read as one sequence of frames.
+'''
+from collections import OrderedDict
+
+import numpy as np
+
+from .multifile import MultifileBase, MultifileBNL, _make_cache
+
+
+class MultifileSet(MultifileBase):
+    '''
+        Concatenate BNL multifiles into one logical sequence of frames.
+
+        Every file is indexed once when the set is created. After that,
+        files are opened lazily when one of their frames is read, and at
+        most max_open of them are kept open (least recently used are
+        closed first).
+
+        The set has the same interface as the single file readers (len,
+        rdframe, rdrawframe, cache), plus rdframes and rdrawframes to
+        read batches of frames that may span several files.
+
+        Parameters
+        ----------
+        filenames : list of str
+            the files, in frame order
+        max_open : int, optional
+            the largest number of files kept open at once
+        cache_bytes : int, optional
+            budget of the decoded frame cache of the set
+        **kwargs : passed to MultifileBNL (e.g. backend, version)
+    '''
+    def __init__(self, filenames, max_open=8, cache_bytes=0, **kwargs):
+        self._filenames = list(filenames)
+        self.max_open = max_open
+        self.cache = _make_cache(cache_bytes)
+        self._fd = None
+        self._kwargs = kwargs
+        self._indexes = list()
+        self._open = OrderedDict()
+
+        for filename in self._filenames:
+            mf = MultifileBNL(filename, **kwargs)
+            self._indexes.append((mf.frame_indexes, mf.dlens,
+                                  mf.block_offsets))
+            if len(self._indexes) == 1:
+                self.md = mf.md
+                self.frame_shape = mf.frame_shape
+            elif mf.frame_shape != self.frame_shape:
+                raise ValueError("Error, {} has frames of shape {}, expected "
+                                 "{}".format(filename, mf.frame_shape,
+                                             self.frame_shape))
+            mf.close()
+
+        nframes = np.array([len(index[0]) for index in self._indexes],
+                           dtype=np.int64)
+        # global frame number of the first frame of every file
+        self.file_starts = np.concatenate([[0], np.cumsum(nframes)])
+        self.Nframes = int(self.file_starts[-1])
+        self.dlens = np.concatenate([index[1] for index in self._indexes])
+
+    def locate(self, n):
+        ''' Return (file number, frame number in that file) of global
+            frame(s) n. n can be an int or an array.
+        '''
+        n = np.asarray(n)
+        if np.any((n < 0) | (n >= self.Nframes)):
+            raise KeyError("Error, only {} frames, asked for {}"
+                           .format(self.Nframes, n))
+        nfile = np.searchsorted(self.file_starts, n, side='right') - 1
+        return nfile, n - self.file_starts[nfile]
+
+    def _reader(self, nfile):
+        mf = self._open.pop(nfile, None)
+        if mf is None:
+            frame_indexes, dlens, block_offsets = self._indexes[nfile]
+            mf = MultifileBNL(self._filenames[nfile],
+                              frame_indexes=frame_indexes, dlens=dlens,
+                              block_offsets=block_offsets, **self._kwargs)
+            while len(self._open) >= self.max_open:
+                _, old = self._open.popitem(last=False)
+                old.close()
+        self._open[nfile] = mf
+        return mf
+
+    def _read_raw(self, n):
+        nfile, local = self.locate(n)
+        return self._reader(int(nfile))._read_raw(int(local))
+
+    def _read_dense(self, n, dtype, roi):
+        nfile, local = self.locate(n)
+        return self._reader(int(nfile))._read_dense(int(local), dtype, roi)
+
+    def rdrawframes(self, ns, workers=4):
+        ''' Read a batch of frames as a list of (pos, vals).
+
+            The frames are read file by file, so every file is opened at
+            most once per batch. workers threads decompress the blocks
+            of files in blocks.
+        '''
+        ns = np.asarray(ns, dtype=np.int64)
+        nfiles, local = self.locate(ns)
+        result = [None]*len(ns)
+        for nfile, order in self._by_file(nfiles):
+            mf = self._reader(nfile)
+            mf._pin_frames(local[order], workers)
+            try:
+                for i in order:
+                    result[i] = mf._read_raw(int(local[i]))
+            finally:
+                mf._unpin()
+        return result
+
+    def _by_file(self, nfiles):
+        ''' Yield (file number, positions in the batch) of a batch.'''
+        order = np.argsort(nfiles, kind='stable')
+        bounds = np.flatnonzero(np.diff(nfiles[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group):
+                yield int(nfiles[group[0]]), group
+
+    def rdframes(self, ns, dtype=np.float64, roi=None, workers=4):
+        ''' Read a batch of frames as a 3D array.'''
+        ns = np.asarray(ns, dtype=np.int64)
+        nfiles, local = self.locate(ns)
+        frames = None
+        for nfile, order in self._by_file(nfiles):
+            mf = self._reader(nfile)
+            mf._pin_frames(local[order], workers)
+            try:
+                for i in order:
+                    frame = self.rdframe(int(ns[i]), dtype=dtype, roi=roi)
+                    if frames is None:
+                        frames = np.empty((len(ns),) + frame.shape,
+                                          dtype=dtype)
+                    frames[i] = frame
+            finally:
+                mf._unpin()
+        if frames is None:
+            frames = np.empty((0,) + self.frame_shape, dtype=dtype)
+        return frames
+
+    def close(self):
+        while self._open:
+            _, mf = self._open.popitem()
+            mf.close()
@@ -0,0 +1,255 @@
+'''
+Shared-memory helpers for pools of analysis workers reading the same
+BNL multifile.
+
+A coordinator indexes the file once and publishes the index in a
+SharedIndex. Workers attach to it by name and open their readers
+without scanning the file again:
+
+    # coordinator
+    mf = MultifileBNL(filename)
+    shidx = SharedIndex.create(mf)
+    pool.map(work, [(filename, shidx.name, n) for n in ...])
+    ...
+    mf.close()
+    shidx.close()
+    shidx.unlink()
+
+    # worker
+    shidx = SharedIndex.attach(name)
+    mf = shidx.open(filename)
+    ...
+    mf.close()
+    shidx.close()
+
+Optionally, a SharedFrameRing lets a single decoder publish dense frames
+that any number of consumers can copy out.
+'''
+from multiprocessing import shared_memory
+import time
+
+import numpy as np
+
+from .multifile import MultifileBNL
+
+
+def _attach(name):
+    ''' Attach to an existing shared memory block without taking
+        ownership of it.
+
+        Before python 3.13, attaching registers the block with the
+        resource tracker, which then unlinks it when the attaching process
+        exits. Only the creator should unlink, so registration is skipped.
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedIndex:
+    '''
+        The frame index and per-frame stats of a MultifileBNL, held in one
+        shared memory block.
+
+        Layout of the block:
+            int64 Nframes, Noffsets
+            int64 frame_indexes[Nframes]
+            int64 block_offsets[Noffsets]
+            uint32 dlens[Nframes]
+
+        Noffsets is 0 for files not stored in blocks.
+    '''
+    _HEAD = 16
+
+    def __init__(self, shm, owner=False):
+        self._shm = shm
+        self._owner = owner
+        nframes, noffsets = (int(n) for n in
+                             np.frombuffer(shm.buf, dtype="<i8", count=2))
+        self.Nframes = nframes
+        offset = self._HEAD
+        self.frame_indexes = np.frombuffer(shm.buf, dtype="<i8",
+                                           count=nframes, offset=offset)
+        offset += 8*nframes
+        self.block_offsets = None
+        if noffsets:
+            self.block_offsets = np.frombuffer(shm.buf, dtype="<i8",
+                                               count=noffsets, offset=offset)
+        offset += 8*noffsets
+        self.dlens = np.frombuffer(shm.buf, dtype="<u4", count=nframes,
+                                   offset=offset)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @classmethod
+    def create(cls, mf, name=None):
+        ''' Publish the index of an opened reader.
+
+            Parameters
+            ----------
+            mf : MultifileBNL
+                an indexed reader
+            name : str, optional
+                the name of the shared memory block. If None, a unique
+                name is chosen.
+        '''
+        nframes = len(mf.frame_indexes)
+        block_offsets = getattr(mf, 'block_offsets', None)
+        noffsets = 0 if block_offsets is None else len(block_offsets)
+        size = cls._HEAD + 8*nframes + 8*noffsets + 4*nframes
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        np.frombuffer(shm.buf, dtype="<i8", count=2)[:] = (nframes, noffsets)
+        offset = cls._HEAD
+        np.frombuffer(shm.buf, dtype="<i8", count=nframes,
+                      offset=offset)[:] = mf.frame_indexes
+        offset += 8*nframes
+        if noffsets:
+            np.frombuffer(shm.buf, dtype="<i8", count=noffsets,
+                          offset=offset)[:] = block_offsets
+        offset += 8*noffsets
+        np.frombuffer(shm.buf, dtype="<u4", count=nframes,
+                      offset=offset)[:] = mf.dlens
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        ''' Attach to an index published by a coordinator.'''
+        return cls(_attach(name))
+
+    def open(self, filename, **kwargs):
+        ''' Open a reader backed by this index.'''
+        return MultifileBNL(filename, frame_indexes=self.frame_indexes,
+                            dlens=self.dlens,
+                            block_offsets=self.block_offsets, **kwargs)
+
+    def close(self):
+        ''' Release this process's view of the block.
+            The readers opened from this index must be closed first.
+        '''
+        # the numpy views must go before the buffer can be released
+        self.frame_indexes = None
+        self.block_offsets = None
+        self.dlens = None
+        self._shm.close()
+
+    def unlink(self):
+        ''' Destroy the block. Only the coordinator should call this.'''
+        if not self._owner:
+            raise RuntimeError("Only the creator of a SharedIndex can "
+                               "unlink it")
+        self._shm.unlink()
+
+
+class SharedFrameRing:
+    '''
+        A ring of decoded frames in shared memory, written by a single
+        decoder and read by many consumers.
+
+        Frame n goes into slot n % nslots. Each slot carries the number
+        of the frame it holds (-1 while it is being written), so a
+        consumer can tell whether the frame it wants is there and whether
+        it was overwritten while being copied. Consumers that fall behind
+        the decoder get None back and should decode the frame themselves.
+
+        Layout of the block:
+            int64 nslots, rows, cols
+            8 bytes dtype string
+            int64 slot_frames[nslots]
+            frames[nslots, rows, cols]
+    '''
+    _HEAD = 32
+
+    def __init__(self, shm, owner=False):
+        self._shm = shm
+        self._owner = owner
+        nslots, rows, cols = np.frombuffer(shm.buf, dtype="<i8", count=3)
+        self.nslots = int(nslots)
+        self.shape = (int(rows), int(cols))
+        self.dtype = np.dtype(bytes(shm.buf[24:32]).rstrip(b"\0").decode())
+        self._slot_frames = np.frombuffer(shm.buf, dtype="<i8",
+                                          count=self.nslots,
+                                          offset=self._HEAD)
+        self._frames = np.ndarray((self.nslots,) + self.shape,
+                                  dtype=self.dtype, buffer=shm.buf,
+                                  offset=self._HEAD + 8*self.nslots)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @classmethod
+    def create(cls, shape, dtype=np.float64, nslots=64, name=None):
+        ''' Create a ring of nslots frames of the given shape and dtype.'''
+        dtype = np.dtype(dtype)
+        rows, cols = shape
+        size = cls._HEAD + 8*nslots + nslots*rows*cols*dtype.itemsize
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        np.frombuffer(shm.buf, dtype="<i8", count=3)[:] = (nslots, rows,
+                                                           cols)
+        shm.buf[24:32] = dtype.str.encode().ljust(8, b"\0")
+        np.frombuffer(shm.buf, dtype="<i8", count=nslots,
+                      offset=cls._HEAD)[:] = -1
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(_attach(name))
+
+    def put(self, n, frame):
+        ''' Publish frame n (decoder side).'''
+        slot = n % self.nslots
+        self._slot_frames[slot] = -1
+        self._frames[slot] = frame
+        self._slot_frames[slot] = n
+
+    def get(self, n, out=None):
+        ''' Copy frame n out of the ring (consumer side).
+
+            Returns None if the frame is not (or no longer) in the ring.
+        '''
+        slot = n % self.nslots
+        if self._slot_frames[slot] != n:
+            return None
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        out[...] = self._frames[slot]
+        # the decoder may have recycled the slot while we were copying
+        if self._slot_frames[slot] != n:
+            return None
+        return out
+
+    def wait(self, n, timeout=None, poll=1e-4, out=None):
+        ''' Like get, but wait up to timeout seconds for the frame to
+            be published.
+        '''
+        t0 = time.time()
+        while True:
+            frame = self.get(n, out=out)
+            if frame is not None:
+                return frame
+            # the frame was already recycled, it will not come back
+            if self._slot_frames[n % self.nslots] > n:
+                return None
+            if timeout is not None and time.time() - t0 > timeout:
+                return None
+            time.sleep(poll)
+
+    def close(self):
+        self._slot_frames = None
+        self._frames = None
+        self._shm.close()
+
+    def unlink(self):
+        if not self._owner:
+            raise RuntimeError("Only the creator of a SharedFrameRing can "
+                               "unlink it")
+        self._shm.unlink()
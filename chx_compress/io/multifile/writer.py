@@ -0,0 +1,429 @@
+'''
+Writers for the multifile formats.
+
+Frames are gathered into one large write buffer and written out in
+multiples of the page size, instead of several small writes per frame.
+'''
+import functools
+import os
+import struct
+
+import numpy as np
+
+from .backends import PreadBackend
+from .codec import (BLOCK_CODECS, BLOCK_HEADER_DTYPE, ENCODINGS,
+                    RECORD_HEADER_DTYPE, compress_block, encode_frame)
+from .multifile import (APS_HEADER_DTYPE, BNL_EXT_HEADER_KEYS,
+                        BNL_MAGIC_V3, MultifileBNL,
+                        pack_bnl_header, pack_bnl_footer, pack_bnl_tables,
+                        unpack_bnl_header)
+
+
+class _PrefixBackend(PreadBackend):
+    ''' The first nbytes of a file, read as if the file ended there.'''
+    def __init__(self, filename, nbytes):
+        super().__init__(filename)
+        self._size = min(self._size, nbytes)
+
+
+class _BufferedWriter:
+    '''
+        A binary file written through a large buffer.
+
+        Parameters
+        ----------
+        buffer_size : int, optional
+            the buffer is written out when it grows beyond this size
+        align : int, optional
+            only multiples of align bytes are written out until the file
+            is closed, so file writes stay page aligned
+        offset : int, optional
+            keep the first offset bytes of an existing file and append
+            after them, instead of starting a new file
+    '''
+    def __init__(self, filename, buffer_size=16*1024*1024, align=4096,
+                 offset=None):
+        self._filename = filename
+        if offset is None:
+            self._fout = open(filename, "wb")
+            offset = 0
+        else:
+            self._fout = open(filename, "r+b")
+            self._fout.truncate(offset)
+            self._fout.seek(offset)
+        self._buf = bytearray()
+        self.buffer_size = buffer_size
+        self.align = align
+        # bytes of the file, written or still buffered
+        self.tell = offset
+
+    def _write(self, data):
+        data = memoryview(data).cast('B')
+        self._buf += data
+        self.tell += len(data)
+        if len(self._buf) >= self.buffer_size:
+            nwrite = len(self._buf) - len(self._buf) % self.align
+            self._fout.write(memoryview(self._buf)[:nwrite])
+            del self._buf[:nwrite]
+
+    def flush(self):
+        ''' Write out everything buffered so far.'''
+        self._fout.write(self._buf)
+        self._buf.clear()
+        self._fout.flush()
+
+    def sync(self):
+        ''' Write out everything buffered so far, and wait until it is on
+            disk.
+        '''
+        self.flush()
+        os.fsync(self._fout.fileno())
+
+    def close(self):
+        if self._fout is not None:
+            self.flush()
+            # drop what update_index may have written past the end
+            self._fout.truncate()
+            self._fout.close()
+            self._fout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MultifileBNLWriter(_BufferedWriter):
+    '''
+        Write a BNL multifile (see multifile.py for the format).
+
+        Parameters
+        ----------
+        filename : str
+        header : dict or bytes
+            the main header, either a dict with the keys of
+            BNL_HEADER_KEYS (see pack_bnl_header) or an already
+            serialized 1024 byte header
+        write_index : bool, optional
+            append the index footer (frame offsets and dlens) on close,
+            so readers do not need to walk through the file. By default
+            only Version-COMP0003 files get one: readers of
+            Version-COMP0002 files that don't know the footer take it for
+            a frame.
+        encoding : str, optional
+            frame encoding of Version-COMP0003 files (see codec.py),
+            'varint', 'ones' (the single photon events have no value),
+            'dense', 'dense_roi' or 'auto' (the smallest of 'varint',
+            'dense' and 'dense_roi', chosen for every frame) or 'tiled'
+            (events grouped by tiles of tile_shape pixels, for reads of
+            regions of the frames)
+        codec : str, optional
+            'zlib' or 'lzma' to store the frames in compressed blocks of
+            block_frames frames. The codec and block_frames are recorded
+            in the header. Version-COMP0003 headers only.
+        level : int, optional
+            the compression level of the codec
+        block_frames : int, optional
+            number of frames per block
+        tile_shape : tuple, optional
+            (rows, cols) of the tiles of the 'tiled' encoding, e.g. the
+            size of a detector module
+        tables : dict, optional
+            arrays stored once after the header, e.g. 'pixels' when the
+            written positions are pixel ids (see multifile.py).
+            Version-COMP0003 headers only.
+        resume_offset : int, optional
+            continue an interrupted file: it is truncated to this size (as
+            returned by checkpoint()) and the new frames are appended
+            after the frames it holds. The file must have been started
+            with the same header and tables.
+
+        The offsets of the frames written so far are in frame_indexes.
+
+        If the header has the Version-COMP0003 magic, frames are written
+        encoded, with a record header (see codec.py). The positions of
+        every frame must then be sorted.
+
+        Example
+        -------
+            # a Version-COMP0002 file, read without a footer
+            header = dict(nrows=2167, ncols=2070, bytes=2)
+            with MultifileBNLWriter("out.bin", header) as fout:
+                fout.write_frames(frames)
+    '''
+    HEADER_SIZE = 1024
+    VALTYPES = {1: '<u1', 2: '<u2', 4: '<u4', 8: '<i8'}
+
+    def __init__(self, filename, header, write_index=None,
+                 encoding='varint', codec=None, level=None, block_frames=64,
+                 tile_shape=(256, 256), tables=None, resume_offset=None,
+                 **kwargs):
+        if encoding not in ENCODINGS:
+            raise ValueError("Error, encoding must be one of {}, got : {}"
+                             .format(list(ENCODINGS), encoding))
+        if codec is not None and codec not in BLOCK_CODECS:
+            raise ValueError("Error, codec must be one of {}, got : {}"
+                             .format(list(BLOCK_CODECS), codec))
+        if isinstance(header, dict):
+            header = pack_bnl_header(header)
+        if len(header) != self.HEADER_SIZE:
+            raise ValueError("Error, header must be {} bytes, got : {}"
+                             .format(self.HEADER_SIZE, len(header)))
+        magic, md = unpack_bnl_header(header)
+        self.codec = 0 if codec is None else BLOCK_CODECS[codec]
+        self.level = level
+        self.block_frames = block_frames
+        tables = dict(tables or {})
+        tables_raw = pack_bnl_tables(tables) if tables else b""
+        self.encoded = magic == BNL_MAGIC_V3
+        if tables and not self.encoded:
+            raise ValueError("Error, tables need a {} header"
+                             .format(BNL_MAGIC_V3))
+        if self.codec and not self.encoded:
+            raise ValueError("Error, the {} codec needs a {} header"
+                             .format(codec, BNL_MAGIC_V3))
+        self.tile_shape = None
+        if encoding == 'tiled':
+            if 'pixels' in tables:
+                raise ValueError("Error, the tiled encoding can't be used "
+                                 "with pixel ids")
+            self.tile_shape = tuple(int(t) for t in tile_shape)
+        if self.encoded:
+            md.update(codec=self.codec, block_frames=block_frames,
+                      tables_bytes=len(tables_raw),
+                      tile_rows=self.tile_shape[0] if self.tile_shape else 0,
+                      tile_cols=self.tile_shape[1] if self.tile_shape else 0)
+        else:
+            # Version-COMP0002 headers keep the old padding empty
+            md.update((key, 0) for key in BNL_EXT_HEADER_KEYS)
+        header = pack_bnl_header(md, magic=magic)
+        self.nbytes, nrows, ncols = struct.unpack('@3I', header[80:92])
+        self.frame_shape = (nrows, ncols)
+        if 'pixels' in tables:
+            # the dense encodings are over the pixels
+            self.frame_shape = (1, len(tables['pixels']))
+        self.valtype = self.VALTYPES[self.nbytes]
+        self.encoding = ENCODINGS[encoding]
+        if not self.encoded and encoding != 'varint':
+            raise ValueError("Error, the {} encoding needs a {} header"
+                             .format(encoding, BNL_MAGIC_V3))
+        self._record = np.zeros(1, dtype=RECORD_HEADER_DTYPE)
+        if write_index is None:
+            write_index = self.encoded
+        self.write_index = write_index
+        self.frame_indexes = list()
+        self.dlens = list()
+        self.block_offsets = list()
+        self._block = bytearray()
+        self._block_header = np.zeros(1, dtype=BLOCK_HEADER_DTYPE)
+        if resume_offset is None:
+            super().__init__(filename, **kwargs)
+            self._write(header)
+            self._write(tables_raw)
+        else:
+            self._resume(filename, header + tables_raw, resume_offset,
+                         **kwargs)
+
+    def _resume(self, filename, head, offset, **kwargs):
+        ''' Check that an interrupted file holds whole frames up to
+            offset and index them, then truncate it to offset.
+        '''
+        size = os.path.getsize(filename)
+        if size < offset:
+            raise ValueError("Error, {} has {} bytes, less than the {} of "
+                             "the checkpoint".format(filename, size, offset))
+        with open(filename, "rb") as f:
+            if f.read(len(head)) != head:
+                raise ValueError("Error, {} was started with a different "
+                                 "header".format(filename))
+        # the file as it will be once truncated, nothing is changed yet
+        mf = MultifileBNL(filename,
+                          backend=functools.partial(_PrefixBackend,
+                                                    nbytes=offset))
+        try:
+            nframes = len(mf.frame_indexes)
+            if self.codec:
+                end = int(mf.block_offsets[-1])
+            elif nframes:
+                _, end = mf._record_end(int(mf.frame_indexes[-1]))
+            else:
+                end = mf._data_start
+            if end != offset or (self.codec and nframes % self.block_frames):
+                raise ValueError("Error, {} does not end with a complete "
+                                 "frame at {}".format(filename, offset))
+            frame_indexes = [int(i) for i in mf.frame_indexes]
+            dlens = [int(d) for d in mf.dlens]
+            block_offsets = list()
+            if self.codec:
+                block_offsets = [int(b) for b in mf.block_offsets[:-1]]
+        finally:
+            mf.close()
+        super().__init__(filename, offset=offset, **kwargs)
+        self.frame_indexes = frame_indexes
+        self.dlens = dlens
+        self.block_offsets = block_offsets
+
+    def __len__(self):
+        return len(self.frame_indexes)
+
+    def _write_record(self, pieces):
+        ''' Append the buffers of one frame record, to the file or to the
+            current block.
+        '''
+        if not self.codec:
+            self.frame_indexes.append(self.tell)
+            for piece in pieces:
+                self._write(piece)
+            return
+        self.frame_indexes.append(len(self._block))
+        for piece in pieces:
+            self._block += memoryview(piece).cast('B')
+        if len(self.frame_indexes) % self.block_frames == 0:
+            self._write_block()
+
+    def _write_block(self):
+        ''' Compress and write out the current block.'''
+        nframes = len(self.frame_indexes) - self.block_frames*len(
+            self.block_offsets)
+        if nframes == 0:
+            return
+        data = compress_block(bytes(self._block), self.codec, self.level)
+        self._block_header['size'] = len(data)
+        self._block_header['nframes'] = nframes
+        self.block_offsets.append(self.tell)
+        self._write(self._block_header)
+        self._write(data)
+        self._block.clear()
+
+    def write_frame(self, pos, vals):
+        ''' Append one frame given as positions and values.'''
+        pos = np.ascontiguousarray(pos, dtype="<u4")
+        vals = np.ascontiguousarray(vals, dtype=self.valtype)
+        if len(pos) != len(vals):
+            raise ValueError("Error, pos and vals must have the same length")
+        self.dlens.append(len(pos))
+        if self.encoded:
+            tag, payload = encode_frame(pos, vals, self.valtype,
+                                        self.encoding, self.frame_shape,
+                                        self.tile_shape)
+            self._record['dlen'] = len(pos)
+            self._record['size'] = sum(part.nbytes for part in payload)
+            self._record['tag'] = tag
+            self._write_record([self._record] + payload)
+        else:
+            self._write_record([struct.pack('<I', len(pos)), pos, vals])
+
+    def write_frames(self, batch):
+        ''' Append a batch of frames, an iterable of (pos, vals).'''
+        for pos, vals in batch:
+            self.write_frame(pos, vals)
+
+    def checkpoint(self):
+        ''' Write out the frames written so far and wait until they are
+            on disk.
+
+            Returns (nframes, offset): the number of frames safely in the
+            file and the size of the file they fill, to continue from
+            with resume_offset. The frames of an unfinished block are not
+            written out yet, so they are not counted.
+        '''
+        self.sync()
+        nframes = len(self.frame_indexes)
+        if self.codec:
+            nframes = len(self.block_offsets)*self.block_frames
+        return nframes, self.tell
+
+    def update_index(self):
+        ''' Write out the frames written so far followed by their index
+            footer, so the file can be read while it is being written.
+
+            The footer is overwritten by the next frames, and written
+            again by the next update_index or by close. The frames of an
+            unfinished block are not in the index yet.
+        '''
+        self.flush()
+        nframes = len(self.frame_indexes)
+        tail = b""
+        if self.codec:
+            nframes = len(self.block_offsets)*self.block_frames
+            tail = np.array(self.block_offsets + [self.tell],
+                            dtype="<u8").tobytes()
+        tail += pack_bnl_footer(self.frame_indexes[:nframes],
+                                self.dlens[:nframes])
+        self._fout.write(tail)
+        self._fout.truncate()
+        self._fout.flush()
+        self._fout.seek(self.tell)
+
+    def close(self):
+        if self._fout is not None and self.codec:
+            self._write_block()
+            if self.write_index:
+                self._write(np.array(self.block_offsets + [self.tell],
+                                     dtype="<u8"))
+        if self._fout is not None and self.write_index:
+            self._write(pack_bnl_footer(self.frame_indexes, self.dlens))
+        super().close()
+
+
+class MultifileAPSWriter(_BufferedWriter):
+    '''
+        Write an APS (IMM) multifile in compressed mode: every frame is a
+        1024 byte header followed by dlen <i4 positions and dlen values.
+
+        Parameters
+        ----------
+        filename : str
+        rows, cols : int
+            the frame shape
+        nbytes : int, optional
+            bytes per value, 2 or 4
+        header : dict, optional
+            other fields of APS_HEADER_DTYPE to set in every frame header
+
+        One header template is filled in once; per frame only its dlen
+        and number fields change.
+    '''
+    HEADER_SIZE = 1024
+    # compression mode 6 is the sparse (pos, vals) mode
+    COMPRESSION = 6
+
+    def __init__(self, filename, rows, cols, nbytes=2, header=None,
+                 **kwargs):
+        if nbytes not in (2, 4):
+            raise ValueError("Error, nbytes must be 2 or 4, got : {}"
+                             .format(nbytes))
+        super().__init__(filename, **kwargs)
+        self.nbytes = nbytes
+        self.valtype = '<i{}'.format(nbytes)
+        self._header = np.zeros(1, dtype=APS_HEADER_DTYPE)
+        self._header['compression'] = self.COMPRESSION
+        if header is not None:
+            for key, val in header.items():
+                self._header[key] = val
+        self._header['rows'] = rows
+        self._header['cols'] = cols
+        self._header['nbytes'] = nbytes
+        self.frame_indexes = list()
+
+    def __len__(self):
+        return len(self.frame_indexes)
+
+    def write_frame(self, pos, vals):
+        ''' Append one frame given as positions and values.'''
+        pos = np.ascontiguousarray(pos, dtype="<i4")
+        vals = np.ascontiguousarray(vals, dtype=self.valtype)
+        if len(pos) != len(vals):
+            raise ValueError("Error, pos and vals must have the same length")
+        self._header['dlen'] = len(pos)
+        self._header['number'] = len(self.frame_indexes)
+        self.frame_indexes.append(self.tell)
+        self._write(self._header)
+        self._write(pos)
+        self._write(vals)
+
+    def write_frames(self, batch):
+        ''' Append a batch of frames, an iterable of (pos, vals).'''
+        for pos, vals in batch:
+            self.write_frame(pos, vals)
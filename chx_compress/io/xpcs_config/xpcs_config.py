@@ -3,8 +3,6 @@
 # for the xpcs-eigen library developed by Faisal Khan at APS
 #################
 import os
-import yaml
-import h5py
 import numpy as np
 
 from ..eiger.eiger import get_header_dict, get_valid_keys
@@ -65,6 +63,8 @@ def make_config_file(filename, dqmap, sqmap,
         -------
         xpcs_config : an XPCS config file
     '''
+    import h5py
+
     with h5py.File(out_filename, "w") as fout:
         dset_keys, dims_per_key = get_valid_keys(filename, version=eiger_version)
         Nkeys = len(dset_keys)
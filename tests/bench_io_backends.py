@@ -0,0 +1,81 @@
+'''
+Compare the I/O backends of MultifileBNL.
+
+Usage:
+    python bench_io_backends.py [file.bin]
+
+Without a file, a synthetic one is written to the current directory. Put
+it on the filesystem you want to measure (e.g. the parallel filesystem),
+the relative timings change a lot from one filesystem to another.
+When posix_fadvise is available, the page cache is dropped for the file
+before every run so the numbers are cold-cache numbers.
+'''
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from chx_compress.io.multifile.multifile import MultifileBNL
+
+
+def make_test_file(filename, nframes=2000, rows=1065, cols=1030,
+                   occupancy=.02):
+    rng = np.random.RandomState(0)
+    header = b"Version-COMP0002"
+    header += struct.pack("@8d7I916x", 0, 0, 0, 0, 0, 0, 0, 0, 2, rows, cols,
+                          0, rows, 0, cols)
+    npix = rows*cols
+    with open(filename, "wb") as fout:
+        fout.write(header)
+        for i in range(nframes):
+            w = np.flatnonzero(rng.rand(npix) < occupancy).astype(np.uint32)
+            fout.write(np.uint32(len(w)))
+            fout.write(w)
+            fout.write(np.ones(len(w), dtype=np.uint16))
+
+
+def drop_cache(filename):
+    if hasattr(os, "posix_fadvise"):
+        fd = os.open(filename, os.O_RDONLY)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def bench(filename, backend, order):
+    drop_cache(filename)
+    t1 = time.time()
+    mf = MultifileBNL(filename, backend=backend)
+    t2 = time.time()
+    nevents = 0
+    for n in order:
+        pos, vals = mf.rdrawframe(n)
+        nevents += int(vals.sum())
+    t3 = time.time()
+    return t2 - t1, t3 - t2
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = "bench_io_backends.bin"
+        if not os.path.exists(filename):
+            print("writing {}".format(filename))
+            make_test_file(filename)
+
+    nframes = len(MultifileBNL(filename))
+    rng = np.random.RandomState(1)
+    orders = {
+        'sequential': np.arange(nframes),
+        'random': rng.permutation(nframes),
+        'strided': np.arange(0, nframes, 10),
+    }
+    print("{:>10} {:>12} {:>10} {:>10}".format("backend", "access",
+                                               "index (s)", "read (s)"))
+    for backend in ['mmap', 'pread', 'madvise']:
+        for name, order in orders.items():
+            tindex, tread = bench(filename, backend, order)
+            print("{:>10} {:>12} {:>10.3f} {:>10.3f}".format(backend, name,
+                                                             tindex, tread))
@@ -0,0 +1,439 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from chx_compress.io.eiger.compress_file import compress_file
+from chx_compress.io.multifile.multifile import open_multifile
+
+DETECTOR = "entry/instrument/detector/"
+
+
+def make_master(filename, nkeys=3, nimgs=10, rows=30, cols=20,
+                dtype=np.uint16, seed=0, live=False):
+    ''' Write a small EIGER-like master file, return all its frames.
+
+        With live=True, the master only links to the data files, which
+        are written by acquire.
+    '''
+    rng = np.random.RandomState(seed)
+    frames = list()
+    with h5py.File(filename, "w") as f:
+        for key in ['beam_center_x', 'count_time', 'frame_time',
+                    'x_pixel_size', 'y_pixel_size']:
+            f[DETECTOR + key] = 1.
+        f["entry/instrument/beam/incident_wavelength"] = 1.3
+        for k in range(1, nkeys + 1):
+            data = (rng.rand(nimgs, rows, cols) < .1)*rng.randint(
+                1, 5, size=(nimgs, rows, cols))
+            data = data.astype(dtype)
+            key = "entry/data/data_{:06d}".format(k)
+            if live:
+                f[key] = h5py.ExternalLink(datafile(filename, k), "data")
+            else:
+                f[key] = data
+            frames.append(data)
+        if live:
+            f[DETECTOR + "detectorSpecific/nimages"] = nkeys*nimgs
+            f[DETECTOR + "detectorSpecific/ntrigger"] = 1
+    return np.concatenate(frames)
+
+
+def datafile(master, k):
+    return os.path.basename(master).replace("master", "data_{:06d}".format(k))
+
+
+def acquire(master, frames, nkeys, started, delay=.01):
+    ''' Simulate the detector: append the frames one by one to the data
+        files of a live master.
+    '''
+    shape = frames.shape[1:]
+    for k, data in enumerate(np.split(frames, nkeys), 1):
+        filename = os.path.join(os.path.dirname(master), datafile(master, k))
+        with h5py.File(filename, "w", libver="latest") as f:
+            dset = f.create_dataset("data", shape=(0,) + shape,
+                                    maxshape=(None,) + shape,
+                                    chunks=(1,) + shape, dtype=frames.dtype)
+            f.swmr_mode = True
+            started.set()
+            for n, frame in enumerate(data):
+                dset.resize(n + 1, axis=0)
+                dset[n] = frame
+                dset.flush()
+                time.sleep(delay)
+
+
+def read_all(filename):
+    mf = open_multifile(filename)
+    return np.array([mf.rdframe(n) for n in range(len(mf))])
+
+
+def test_compress_file(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master, nimgs=11)
+
+    compress_file(master, outfile, block_size=4)
+    assert np.array_equal(read_all(outfile), frames)
+    # Version-COMP0002 files stay readable by the readers without footers
+    with open(outfile, "rb") as f:
+        f.seek(-16, os.SEEK_END)
+        assert f.read(8) != b"BNLINDEX"
+
+    compress_file(master, outfile, block_size=4, write_index=True)
+    with open(outfile, "rb") as f:
+        f.seek(-16, os.SEEK_END)
+        assert f.read(8) == b"BNLINDEX"
+    assert np.array_equal(read_all(outfile), frames)
+
+
+def test_compress_file_detector_mask(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master)
+    pixel_mask = np.zeros(frames.shape[1:], dtype=np.uint32)
+    pixel_mask[7] = 1
+    with h5py.File(master, "a") as f:
+        f[DETECTOR + "detectorSpecific/pixel_mask"] = pixel_mask
+        f[DETECTOR + "detectorSpecific/countrate_correction_count_cutoff"] = 3
+    mask = np.ones(frames.shape[1:])
+    mask[:, 4] = 0
+
+    compress_file(master, outfile, mask=mask)
+    good = (pixel_mask == 0) & (mask > 0)
+    expected = frames*good
+    expected[expected > 3] = 0
+    assert np.array_equal(read_all(outfile), expected)
+    assert np.array_equal(np.load(outfile + ".mask.npy"), good)
+
+
+def test_compress_file_large_cutoff(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master)
+    with h5py.File(master, "a") as f:
+        f[DETECTOR + "detectorSpecific/"
+          "countrate_correction_count_cutoff"] = 100000
+        # a dead pixel
+        f["entry/data/data_000001"][:, 2, 3] = 0xFFFF
+    frames[:10, 2, 3] = 0
+
+    compress_file(master, outfile)
+    assert np.array_equal(read_all(outfile), frames)
+
+
+def test_compress_file_nbytes(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master, dtype=np.uint32)
+
+    compress_file(master, outfile, scan_max=True)
+    assert open_multifile(outfile).nbytes == 1
+    assert np.array_equal(read_all(outfile), frames)
+
+    with h5py.File(master, "a") as f:
+        f["entry/data/data_000002"][0, 0, 0] = 100000
+    frames[10, 0, 0] = 100000
+    compress_file(master, outfile, scan_max=True)
+    assert open_multifile(outfile).nbytes == 4
+    assert np.array_equal(read_all(outfile), frames)
+
+    compress_file(master, outfile, nbytes=2)
+    frames[10, 0, 0] = 0
+    assert np.array_equal(read_all(outfile), frames)
+
+
+def test_compress_file_v3(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master)
+
+    for encoding in ['varint', 'ones', 'auto', 'tiled']:
+        compress_file(master, outfile, bnl_version=3, encoding=encoding)
+        assert open_multifile(outfile).magic == b"Version-COMP0003"
+        assert np.array_equal(read_all(outfile), frames)
+
+    compress_file(master, outfile, bnl_version=3, codec='zlib',
+                  block_frames=4)
+    assert open_multifile(outfile).codec
+    assert np.array_equal(read_all(outfile), frames)
+    # the blocks would break Version-COMP0002 readers
+    with pytest.raises(ValueError):
+        compress_file(master, outfile, codec='zlib', block_frames=4)
+
+
+def test_compress_file_dqmap(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master)
+    rows, cols = frames.shape[1:]
+    # rings around a corner, 0 is outside the partitions
+    r, c = np.mgrid[:rows, :cols]
+    dqmap = (np.hypot(r, c)//8).astype(int)
+    dqmap[dqmap > 3] = 0
+
+    with pytest.raises(ValueError):
+        compress_file(master, outfile, dqmap=dqmap, bnl_version=2)
+    for encoding in ['varint', 'auto']:
+        compress_file(master, outfile, dqmap=dqmap, bnl_version=3,
+                      encoding=encoding)
+        assert np.array_equal(read_all(outfile), frames*(dqmap > 0))
+        mf = open_multifile(outfile)
+        assert list(mf.partition_labels) == [1, 2, 3]
+        for n, frame in enumerate(frames):
+            bounds, ids, vals = mf.rdpartframe(n)
+            for i, label in enumerate(mf.partition_labels):
+                part = slice(bounds[i], bounds[i+1])
+                assert vals[part].sum() == frame[dqmap == label].sum()
+                assert np.all(dqmap.ravel()[mf.tables['pixels'][ids[part]]]
+                              == label)
+
+
+def test_compress_file_compact(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master, rows=300, cols=200)
+    mask = np.zeros(frames.shape[1:])
+    mask[50:250, 20:180] = 1
+
+    compress_file(master, outfile, mask=mask, compact=True, bnl_version=3)
+    mf = open_multifile(outfile)
+    assert len(mf.tables['pixels']) == mask.sum()
+    assert np.array_equal(read_all(outfile), frames*mask)
+    # the tables would break Version-COMP0002 readers
+    with pytest.raises(ValueError):
+        compress_file(master, outfile, mask=mask, compact=True)
+
+
+def test_compress_file_resume(tmp_path, monkeypatch):
+    from chx_compress.io.eiger import compress_file as module
+
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master, nimgs=10)
+
+    for codec in [None, 'zlib']:
+        encode_block = module.encode_block
+        calls = list()
+
+        def failing_encode_block(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 5:
+                raise KeyboardInterrupt
+            return encode_block(*args, **kwargs)
+
+        monkeypatch.setattr(module, "encode_block", failing_encode_block)
+        try:
+            compress_file(master, outfile, block_size=4, checkpoint_frames=4,
+                          codec=codec, block_frames=4, bnl_version=3)
+        except KeyboardInterrupt:
+            pass
+        monkeypatch.setattr(module, "encode_block", encode_block)
+        assert not os.path.exists(outfile)
+        # a frame cut by the interruption
+        with open(outfile + ".part", "ab") as f:
+            f.write(b"\x05\x00\x00\x00\x01")
+
+        resumed = list()
+
+        def counting_encode_block(*args, **kwargs):
+            resumed.append(1)
+            return encode_block(*args, **kwargs)
+
+        monkeypatch.setattr(module, "encode_block", counting_encode_block)
+        compress_file(master, outfile, block_size=4, resume=True,
+                      codec=codec, block_frames=4, bnl_version=3)
+        monkeypatch.setattr(module, "encode_block", encode_block)
+        # 9 blocks of frames in all, the first 4 were written
+        assert len(resumed) == 5
+        assert not os.path.exists(outfile + ".part")
+        assert not os.path.exists(outfile + ".ckpt")
+        assert np.array_equal(read_all(outfile), frames)
+        os.remove(outfile)
+
+
+def test_compress_file_selection(tmp_path):
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    frames = make_master(master, nkeys=3, nimgs=10)
+
+    compress_file(master, outfile, beg=4, end=27, stride=3, block_size=2,
+                  bnl_version=3)
+    mf = open_multifile(outfile)
+    assert list(mf.source_frames) == list(range(4, 27, 3))
+    assert np.array_equal(read_all(outfile), frames[4:27:3])
+
+    # Version-COMP0002 files have no tables, the frames are saved apart
+    compress_file(master, outfile, keys=['data_000003', 'data_000001'],
+                  stride=4)
+    expected = [0, 4, 8, 20, 24, 28]
+    mf = open_multifile(outfile)
+    assert mf.source_frames is None and not mf.tables
+    assert list(np.load(outfile + ".frames.npy")) == expected
+    assert np.array_equal(read_all(outfile), frames[expected])
+
+    compress_file(master, outfile)
+    assert open_multifile(outfile).source_frames is None
+
+
+def test_compress_file_follow(tmp_path):
+    outfile = str(tmp_path / "test.bin")
+
+    for codec in [None, 'zlib']:
+        # new data files for every acquisition
+        os.mkdir(str(tmp_path / str(codec)))
+        master = str(tmp_path / str(codec) / "test_master.h5")
+        frames = make_master(master, nkeys=3, nimgs=8, live=True)
+        ctx = multiprocessing.get_context("spawn")
+        started = ctx.Event()
+        detector = ctx.Process(target=acquire,
+                               args=(master, frames, 3, started))
+        detector.start()
+        try:
+            started.wait(60)
+            compress_file(master, outfile, block_size=4, follow=True,
+                          poll_interval=.01, follow_timeout=30,
+                          codec=codec, block_frames=4, bnl_version=3)
+        finally:
+            detector.join()
+        assert np.array_equal(read_all(outfile), frames)
+
+    # with no frame count in the master, it ends after the timeout
+    with h5py.File(master, "a") as f:
+        del f[DETECTOR + "detectorSpecific/nimages"]
+    compress_file(master, outfile, follow=True, poll_interval=.01,
+                  follow_timeout=.1)
+    assert np.array_equal(read_all(outfile), frames)
+
+
+def test_compress_batch(tmp_path):
+    from chx_compress.io.eiger.batch import compress_batch, main
+
+    outdir = str(tmp_path / "out")
+    frames = dict()
+    for i, nimgs in enumerate([3, 12, 6]):
+        master = str(tmp_path / "scan{}_master.h5".format(i))
+        frames[master] = make_master(master, nkeys=2, nimgs=nimgs, seed=i)
+
+    report = compress_batch(str(tmp_path), outdir=outdir, workers=2)
+    assert sorted(report['done']) == sorted(frames)
+    assert report['nframes'] == 2*(3 + 12 + 6)
+    for i, master in enumerate(sorted(frames)):
+        outfile = os.path.join(outdir, "scan{}.bin".format(i))
+        assert np.array_equal(read_all(outfile), frames[master])
+
+    # only the missing output is compressed again
+    outfile = os.path.join(outdir, "scan1.bin")
+    os.remove(outfile)
+    report = compress_batch(str(tmp_path / "*_master.h5"), outdir=outdir)
+    assert report['done'] == [str(tmp_path / "scan1_master.h5")]
+    assert len(report['skipped']) == 2
+    assert np.array_equal(read_all(outfile),
+                          frames[str(tmp_path / "scan1_master.h5")])
+
+    # outputs with a footer are checked against it
+    outdir = str(tmp_path / "v3")
+    compress_batch(str(tmp_path), outdir=outdir, workers=2, bnl_version=3)
+    outfile = os.path.join(outdir, "scan1.bin")
+    # one frame short
+    with open(outfile, "r+b") as f:
+        f.seek(-8, os.SEEK_END)
+        f.write(np.uint64(2*12 - 1).tobytes())
+    report = compress_batch(str(tmp_path), outdir=outdir, bnl_version=3)
+    assert report['done'] == [str(tmp_path / "scan1_master.h5")]
+    assert len(report['skipped']) == 2
+
+    assert main([str(tmp_path), "-o", outdir, "-j", "2"]) == 0
+    for args in [["--codec", "zlib"], ["--encoding", "ones"],
+                 ["--encoding", "packed"]]:
+        with pytest.raises(SystemExit):
+            main([str(tmp_path), "-o", outdir] + args)
+
+    # outputs of a selection of the frames are complete too
+    outdir = str(tmp_path / "strided")
+    report = compress_batch(str(tmp_path), outdir=outdir, workers=2,
+                            stride=2, keys=['data_000002'])
+    assert report['nframes'] == 1 + 6 + 3
+    master = str(tmp_path / "scan1_master.h5")
+    assert np.array_equal(read_all(os.path.join(outdir, "scan1.bin")),
+                          frames[master][12::2])
+    report = compress_batch(str(tmp_path), outdir=outdir, stride=2,
+                            keys=['data_000002'])
+    assert len(report['skipped']) == 3 and not report['done']
+
+
+def test_compress_batch_resume(tmp_path, monkeypatch, caplog):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from chx_compress.io.eiger import batch
+    from chx_compress.io.eiger import compress_file as module
+
+    master = str(tmp_path / "scan_master.h5")
+    outfile = str(tmp_path / "scan.bin")
+    frames = make_master(master, nimgs=10)
+    encode_block = module.encode_block
+    calls = list()
+
+    def failing_encode_block(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+        return encode_block(*args, **kwargs)
+
+    monkeypatch.setattr(module, "encode_block", failing_encode_block)
+    try:
+        compress_file(master, outfile, block_size=4, checkpoint_frames=4)
+    except KeyboardInterrupt:
+        pass
+    monkeypatch.setattr(module, "encode_block", encode_block)
+    assert os.path.exists(outfile + ".ckpt")
+
+    # the jobs run in this process, to see their log
+    monkeypatch.setattr(batch, "ProcessPoolExecutor", ThreadPoolExecutor)
+    for var in batch.DECODER_THREAD_VARS:
+        monkeypatch.setenv(var, "1")
+    with caplog.at_level(logging.INFO):
+        report = batch.compress_batch(str(tmp_path), workers=1,
+                                      block_size=4)
+    assert report['done'] == [master]
+    assert "Resuming" in caplog.text
+    assert np.array_equal(read_all(outfile), frames)
+
+
+def test_compress_file_resume_short(tmp_path, monkeypatch):
+    from chx_compress.io.eiger import compress_file as module
+
+    master = str(tmp_path / "test_master.h5")
+    outfile = str(tmp_path / "test.bin")
+    make_master(master, nimgs=10)
+    encode_block = module.encode_block
+    calls = list()
+
+    def failing_encode_block(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 5:
+            raise KeyboardInterrupt
+        return encode_block(*args, **kwargs)
+
+    monkeypatch.setattr(module, "encode_block", failing_encode_block)
+    try:
+        compress_file(master, outfile, block_size=4, checkpoint_frames=4)
+    except KeyboardInterrupt:
+        pass
+    monkeypatch.setattr(module, "encode_block", encode_block)
+    # the last writes before the checkpoint never reached the disk
+    partfile = outfile + ".part"
+    with open(outfile + ".ckpt") as f:
+        offset = json.load(f)['offset']
+    with open(partfile, "r+b") as f:
+        f.truncate(offset - 40)
+
+    with pytest.raises(ValueError):
+        compress_file(master, outfile, block_size=4, resume=True)
+    # the file is left as it was, not padded
+    assert os.path.getsize(partfile) == offset - 40
@@ -0,0 +1,586 @@
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from chx_compress.io.multifile.backends import (MadviseBackend, MmapBackend,
+                                                PreadBackend)
+from chx_compress.io.multifile.codec import (FRAME_DENSE, FRAME_DENSE_ROI,
+                                             FRAME_VARINT, varint_decode,
+                                             varint_encode)
+from chx_compress.io.multifile.compress import compress_stream
+from chx_compress.io.multifile.convert import convert
+from chx_compress.io.multifile.multifile import (BNL_MAGIC_V3, MultifileAPS,
+                                                 MultifileBNL,
+                                                 MultifileBNLCustom,
+                                                 open_multifile,
+                                                 pack_bnl_header,
+                                                 sniff_format)
+from chx_compress.io.multifile.multifileset import MultifileSet
+from chx_compress.io.multifile.shared import SharedFrameRing, SharedIndex
+from chx_compress.io.multifile.writer import (MultifileAPSWriter,
+                                              MultifileBNLWriter)
+
+
+def make_frames(nframes=20, rows=30, cols=20, seed=0):
+    rng = np.random.RandomState(seed)
+    frames = (rng.rand(nframes, rows, cols) < .1)*rng.randint(1, 5, size=(
+        nframes, rows, cols))
+    return frames.astype(np.uint16)
+
+
+def write_bnl(filename, frames, header=None, **kwargs):
+    nframes, rows, cols = frames.shape
+    if header is None:
+        header = dict(nrows=rows, ncols=cols)
+    with MultifileBNLWriter(filename, header, **kwargs) as fout:
+        for frame in frames:
+            w = np.flatnonzero(frame)
+            fout.write_frame(w, frame.ravel()[w])
+
+
+def test_bnl_roundtrip(tmp_path):
+    frames = make_frames()
+    filename = str(tmp_path / "test.bin")
+    write_bnl(filename, frames, buffer_size=100, align=64)
+
+    mf = open_multifile(filename)
+    assert isinstance(mf, MultifileBNL)
+    assert len(mf) == len(frames)
+    for n, frame in enumerate(frames):
+        assert np.array_equal(mf.rdframe(n), frame)
+
+
+def test_bnl_index_footer(tmp_path):
+    frames = make_frames()
+    with_index = str(tmp_path / "index.bin")
+    without_index = str(tmp_path / "noindex.bin")
+    write_bnl(with_index, frames, write_index=True)
+    # Version-COMP0002 files get no footer by default
+    write_bnl(without_index, frames)
+    for filename, trailer in [(with_index, True), (without_index, False)]:
+        with open(filename, "rb") as f:
+            f.seek(-16, os.SEEK_END)
+            assert (f.read(8) == b"BNLINDEX") == trailer
+
+    mf1 = MultifileBNL(with_index)
+    mf2 = MultifileBNL(without_index)
+    assert np.array_equal(mf1.frame_indexes, mf2.frame_indexes)
+    assert np.array_equal(mf1.dlens, mf2.dlens)
+    assert np.array_equal(mf1.rdframe(len(frames) - 1), frames[-1])
+
+
+def test_bnl_backends(tmp_path):
+    frames = make_frames(nframes=60, rows=40, cols=30)
+    nframes = len(frames)
+    rng = np.random.RandomState(1)
+    orders = [np.arange(nframes), rng.permutation(nframes),
+              np.arange(nframes)[::-1]]
+    # small windows and thresholds, so they are refilled and switched
+    backends = ['pread', 'madvise',
+                functools.partial(PreadBackend, min_read=64, readahead=512),
+                functools.partial(MadviseBackend, threshold=2, max_gap=64)]
+    for write_index in [True, False]:
+        filename = str(tmp_path / "{}.bin".format(write_index))
+        write_bnl(filename, frames, write_index=write_index)
+        for backend in backends:
+            mf = MultifileBNL(filename, backend=backend)
+            assert len(mf) == nframes
+            for order in orders:
+                for n in order:
+                    assert np.array_equal(mf.rdframe(n), frames[n])
+                    pos, vals = mf.rdrawframe(n)
+                    assert np.array_equal(pos, np.flatnonzero(frames[n]))
+                    assert np.array_equal(vals, frames[n][frames[n] > 0])
+                assert np.array_equal(mf.rdframes(order), frames[order])
+            mf.close()
+
+    # the hint follows the reads (3 per frame)
+    mf = MultifileBNL(filename, backend='madvise')
+    for n in range(5):
+        mf.rdframe(n)
+    assert mf._fd._advice == 'sequential'
+    mf.rdframe(2)
+    assert mf._fd._advice == 'random'
+    mf.close()
+
+
+def test_frame_cache(tmp_path):
+    frames = make_frames()
+    filename = str(tmp_path / "test.bin")
+    write_bnl(filename, frames)
+
+    frame_bytes = frames[0].size*8
+    mf = MultifileBNL(filename, cache_bytes=2*frame_bytes)
+    for n in [0, 1, 0, 2, 1]:
+        assert np.array_equal(mf.rdframe(n), frames[n])
+    stats = mf.cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 4
+    assert stats['evictions'] == 2
+    assert stats['nbytes'] <= 2*frame_bytes
+
+
+def test_aps_roundtrip(tmp_path):
+    frames = make_frames()
+    nframes, rows, cols = frames.shape
+    filename = str(tmp_path / "test.imm")
+    with MultifileAPSWriter(filename, rows, cols, buffer_size=100,
+                            align=64) as fout:
+        fout.write_frames((np.flatnonzero(frame),
+                           frame.ravel()[np.flatnonzero(frame)])
+                          for frame in frames)
+
+    mf = open_multifile(filename)
+    assert isinstance(mf, MultifileAPS)
+    assert len(mf) == nframes
+    assert np.array_equal(mf.headers['number'], np.arange(nframes))
+    for n, frame in enumerate(frames):
+        assert np.array_equal(mf.rdframe(n), frame)
+
+
+def test_sniff_bnl_v1(tmp_path):
+    # the old layout has no magic, and stores the frames transposed
+    frames = make_frames()
+    nframes, rows, cols = frames.shape
+    filename = str(tmp_path / "v1.bin")
+    write_bnl(filename, frames, header=dict(nrows=cols, ncols=rows),
+              write_index=False)
+    with open(filename, "r+b") as f:
+        f.write(bytes(16))
+    assert sniff_format(filename) == 'bnl_v1'
+    mf = open_multifile(filename)
+    assert isinstance(mf, MultifileBNL) and mf._version == 1
+    assert mf.frame_shape == (rows, cols)
+    assert len(mf) == nframes
+    for n, frame in enumerate(frames):
+        assert np.array_equal(mf.rdframe(n), frame)
+
+
+def test_sniff_aps(tmp_path):
+    # 4 byte values
+    frames = make_frames().astype(np.int32)
+    frames[1, 2, 3] = 1 << 20
+    nframes, rows, cols = frames.shape
+    for empty in [False, True]:
+        if empty:
+            frames[0] = 0
+        filename = str(tmp_path / "{}.imm".format(empty))
+        with MultifileAPSWriter(filename, rows, cols, nbytes=4) as fout:
+            for frame in frames:
+                w = np.flatnonzero(frame)
+                fout.write_frame(w, frame.ravel()[w])
+        assert sniff_format(filename) == 'aps'
+        mf = open_multifile(filename, backend='pread')
+        assert isinstance(mf, MultifileAPS)
+        assert mf.frame_shape == (rows, cols)
+        assert np.array_equal(mf.rdframes(range(nframes)), frames)
+
+    # a file cut in its first frame is not taken for one
+    with open(str(tmp_path / "False.imm"), "rb") as f:
+        head = f.read(1024 + 4*3)
+    truncated = str(tmp_path / "truncated.imm")
+    with open(truncated, "wb") as f:
+        f.write(head)
+    with pytest.raises(ValueError):
+        sniff_format(truncated)
+
+    garbage = str(tmp_path / "garbage.bin")
+    with open(garbage, "wb") as f:
+        f.write(b"\xff"*2048)
+    with pytest.raises(ValueError):
+        sniff_format(garbage)
+
+
+def test_convert_roundtrip(tmp_path):
+    frames = make_frames()
+    bnl = str(tmp_path / "test.bin")
+    aps = str(tmp_path / "test.imm")
+    bnl2 = str(tmp_path / "test2.bin")
+    write_bnl(bnl, frames)
+
+    convert(bnl, aps, to='aps', workers=2)
+    convert(aps, bnl2, to='bnl', workers=2, header=dict(frame_time=.5))
+    # Version-COMP0002 files stay readable by the readers without footers
+    with open(bnl2, "rb") as f:
+        f.seek(-16, os.SEEK_END)
+        assert f.read(8) != b"BNLINDEX"
+    mf = open_multifile(bnl2)
+    assert isinstance(mf, MultifileBNL)
+    assert mf.md['frame_time'] == .5
+    for n, frame in enumerate(frames):
+        assert np.array_equal(mf.rdframe(n), frame)
+
+    convert(aps, bnl2, to='bnl', write_index=True)
+    with open(bnl2, "rb") as f:
+        f.seek(-16, os.SEEK_END)
+        assert f.read(8) == b"BNLINDEX"
+    mf = open_multifile(bnl2)
+    assert len(mf) == len(frames)
+    for n, frame in enumerate(frames):
+        assert np.array_equal(mf.rdframe(n), frame)
+
+
+def test_multifileset(tmp_path):
+    frames = make_frames(nframes=30)
+    filenames = list()
+    for i, chunk in enumerate(np.array_split(frames, 4)):
+        filenames.append(str(tmp_path / "part{}.bin".format(i)))
+        write_bnl(filenames[-1], chunk)
+
+    mfs = MultifileSet(filenames, max_open=2)
+    assert len(mfs) == len(frames)
+    ns = [29, 0, 8, 7, 15, 23, 1]
+    assert np.array_equal(mfs.rdframes(ns), frames[ns])
+    assert len(mfs._open) <= 2
+    for n, frame in enumerate(frames):
+        assert np.array_equal(mfs.rdframe(n), frame)
+
+
+def test_bnl_v3_roundtrip(tmp_path):
+    frames = make_frames()
+    frames[3, 0, 0] = 7
+    frames[3, -1, -1] = 9
+    frames[4] = 0
+    v2 = str(tmp_path / "v2.bin")
+    write_bnl(v2, frames)
+    nframes, rows, cols = frames.shape
+    header = pack_bnl_header(dict(nrows=rows, ncols=cols), magic=BNL_MAGIC_V3)
+
+    sizes = list()
+    for encoding in ['varint', 'ones']:
+        v3 = str(tmp_path / "{}.bin".format(encoding))
+        write_bnl(v3, frames, header=header, encoding=encoding)
+        sizes.append(os.path.getsize(v3))
+        for kwargs in [dict(), dict(backend='pread')]:
+            mf = open_multifile(v3, **kwargs)
+            assert len(mf) == nframes
+            for n, frame in enumerate(frames):
+                assert np.array_equal(mf.rdframe(n), frame)
+                pos, vals = mf.rdrawframe(n)
+                assert np.array_equal(pos, np.flatnonzero(frame))
+                ones, pos, vals = mf.rdsplitframe(n)
+                assert np.array_equal(ones, np.flatnonzero(frame == 1))
+                assert np.array_equal(pos, np.flatnonzero(frame > 1))
+                assert np.array_equal(vals, frame[frame > 1])
+    assert sizes[1] < sizes[0] < os.path.getsize(v2)
+
+
+def test_bnl_v3_auto_encoding(tmp_path):
+    frames = make_frames(nframes=4)
+    # a bright frame, a bright spot, and a sparse frame
+    frames[0] = 3
+    frames[1] = 0
+    frames[1, 5:13, 2:10] = 2
+    frames[2, 0, 0] = 0
+    filename = str(tmp_path / "auto.bin")
+    nframes, rows, cols = frames.shape
+    header = pack_bnl_header(dict(nrows=rows, ncols=cols), magic=BNL_MAGIC_V3)
+    write_bnl(filename, frames, header=header, encoding='auto')
+
+    mf = MultifileBNL(filename)
+    tags = [mf._read_record(n)[0] for n in range(nframes)]
+    assert tags[:3] == [FRAME_DENSE, FRAME_DENSE_ROI, FRAME_VARINT]
+    for roi in [None, (0, 7, 3, 20), (20, 30, 0, 20)]:
+        for n, frame in enumerate(frames):
+            expected = _densify_roi(frame, roi)
+            assert np.array_equal(mf.rdframe(n, roi=roi), expected)
+            pos, vals = mf.rdrawframe(n)
+            assert np.array_equal(pos, np.flatnonzero(frame))
+            assert np.array_equal(vals, frame.ravel()[pos])
+    assert np.array_equal(MultifileSet([filename]).rdframes(range(nframes)),
+                          frames)
+
+
+def _densify_roi(frame, roi):
+    if roi is None:
+        return frame
+    return frame[roi[0]:roi[1], roi[2]:roi[3]]
+
+
+def test_varint():
+    values = np.array([0, 1, 127, 128, 16383, 16384, 2**21, 2**32 - 1])
+    buf = varint_encode(values)
+    assert len(buf) == 1 + 1 + 1 + 2 + 2 + 3 + 4 + 5
+    assert np.array_equal(varint_decode(buf), values)
+
+
+def test_bnl_blocks(tmp_path):
+    frames = make_frames(nframes=50)
+    nframes, rows, cols = frames.shape
+    plain = str(tmp_path / "plain.bin")
+    write_bnl(plain, frames)
+    for codec in ['zlib', 'lzma']:
+        filename = str(tmp_path / "{}.bin".format(codec))
+        header = pack_bnl_header(dict(nrows=rows, ncols=cols),
+                                 magic=BNL_MAGIC_V3)
+        write_bnl(filename, frames, header=header, codec=codec,
+                  block_frames=8)
+        assert os.path.getsize(filename) < os.path.getsize(plain)
+        for write_index in [True, False]:
+            if not write_index:
+                write_bnl(filename, frames, header=header, codec=codec,
+                          block_frames=8, write_index=False)
+            for backend in ['mmap', 'pread']:
+                mf = MultifileBNL(filename, block_cache_bytes=10000,
+                                  backend=backend)
+                assert len(mf) == nframes
+                assert len(mf.block_offsets) == 8
+                for n in [0, 49, 8, 7, 20]:
+                    assert np.array_equal(mf.rdframe(n), frames[n])
+                ns = [3, 45, 17, 18, 30, 3]
+                assert np.array_equal(mf.rdframes(ns, workers=3),
+                                      frames[ns])
+                pos, vals = mf.rdrawframes([12])[0]
+                assert np.array_equal(pos, np.flatnonzero(frames[12]))
+                # no block cached, all of them decompressed at once
+                mf.block_cache = None
+                assert np.array_equal(
+                    mf.rdframes(range(nframes)[::-1], workers=4),
+                    frames[::-1])
+                mf.close()
+        mfs = MultifileSet([filename, plain])
+        assert np.array_equal(mfs.rdframes([60, 5, 70, 40]),
+                              np.concatenate([frames, frames])[[60, 5, 70,
+                                                                40]])
+
+
+def test_bnl_custom_transforms(tmp_path):
+    frames = make_frames(nframes=6)
+    nframes, rows, cols = frames.shape
+    filename = str(tmp_path / "test.bin")
+    write_bnl(filename, frames, header=dict(nrows=rows, ncols=cols,
+                                            rows_begin=5, rows_end=25,
+                                            cols_begin=2, cols_end=12))
+    cases = [
+        (['transpose'], lambda f: f.T),
+        (['flipud'], lambda f: f[::-1]),
+        (['fliplr'], lambda f: f[:, ::-1]),
+        (['rot90'], np.rot90),
+        ([('rot90', 3)], lambda f: np.rot90(f, 3)),
+        (['crop'], lambda f: f[5:25, 2:12]),
+        ([('crop', (10, 20, 0, 5))], lambda f: f[10:20, 0:5]),
+        (['crop', 'transpose', 'fliplr'], lambda f: f[5:25, 2:12].T[:, ::-1]),
+    ]
+    for transforms, expected in cases:
+        mf = MultifileBNLCustom(filename, reverse=False,
+                                transforms=transforms)
+        assert mf.frame_shape == expected(frames[0]).shape
+        for n in range(nframes):
+            frame = expected(frames[n])
+            assert np.array_equal(mf.rdframe(n), frame)
+            pos, vals = mf.rdrawframe(n)
+            dense = np.zeros(frame.size)
+            dense[pos] = vals
+            assert np.array_equal(dense.reshape(frame.shape), frame)
+            ones, pos, vals = mf.rdsplitframe(n)
+            assert np.array_equal(np.sort(ones), np.flatnonzero(frame == 1))
+            assert np.array_equal(np.sort(pos), np.flatnonzero(frame > 1))
+    # reverse flips the rows after the transforms
+    mf = MultifileBNLCustom(filename, transforms=['transpose'])
+    assert np.array_equal(mf.rdframe(2), frames[2].T[::-1])
+    with pytest.raises(ValueError):
+        MultifileBNLCustom(filename, transforms=['shear'])
+
+
+def test_bnl_custom_offset(tmp_path):
+    frames = make_frames(nframes=6)
+    filename = str(tmp_path / "test.bin")
+    write_bnl(filename, frames)
+    mf = MultifileBNLCustom(filename, beg=10, end=15, reverse=False)
+    for n in range(10, 16):
+        assert np.array_equal(mf.rdframe(n), frames[n - 10])
+        pos, vals = mf.rdrawframe(n)
+        assert np.array_equal(pos, np.flatnonzero(frames[n - 10]))
+        ones, pos, vals = mf.rdsplitframe(n)
+        assert np.array_equal(ones, np.flatnonzero(frames[n - 10] == 1))
+    assert np.array_equal(mf.rdframes([12, 10]), frames[[2, 0]])
+    for n in [9, 0, 16]:
+        for read in [mf.rdframe, mf.rdrawframe, mf.rdsplitframe]:
+            with pytest.raises(IndexError):
+                read(n)
+
+
+def test_shared_index_blocks(tmp_path, monkeypatch):
+    frames = make_frames(nframes=50)
+    nframes, rows, cols = frames.shape
+    filename = str(tmp_path / "zlib.bin")
+    header = pack_bnl_header(dict(nrows=rows, ncols=cols), magic=BNL_MAGIC_V3)
+    write_bnl(filename, frames, header=header, codec='zlib', block_frames=8,
+              write_index=False)
+    mf = MultifileBNL(filename)
+    shidx = SharedIndex.create(mf)
+    mf.close()
+    try:
+        attached = SharedIndex.attach(shidx.name)
+        # the readers of the workers don't index the file again
+        monkeypatch.setattr(MultifileBNL, 'index', None)
+        mf = attached.open(filename)
+        assert np.array_equal(mf.block_offsets, attached.block_offsets)
+        assert np.array_equal(mf.rdframes(range(nframes)), frames)
+        mf.close()
+        attached.close()
+    finally:
+        shidx.close()
+        shidx.unlink()
+
+
+def read_shared(filename, name, ns):
+    shidx = SharedIndex.attach(name)
+    mf = shidx.open(filename)
+    try:
+        return mf.rdframes(ns)
+    finally:
+        mf.close()
+        shidx.close()
+
+
+def test_shared_index_pool(tmp_path):
+    frames = make_frames(nframes=40)
+    filename = str(tmp_path / "test.bin")
+    write_bnl(filename, frames, write_index=False)
+    mf = MultifileBNL(filename)
+    shidx = SharedIndex.create(mf)
+    try:
+        # the coordinator reads through the index too
+        reader = shidx.open(filename)
+        assert np.array_equal(reader.rdframe(5), frames[5])
+        reader.close()
+        chunks = [range(i, i+10) for i in range(0, 40, 10)]
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(2, mp_context=ctx) as pool:
+            results = list(pool.map(read_shared, [filename]*len(chunks),
+                                    [shidx.name]*len(chunks), chunks))
+        assert np.array_equal(np.concatenate(results), frames)
+    finally:
+        mf.close()
+        # no reader is left with a view of the block
+        shidx.close()
+        shidx.unlink()
+
+
+def test_shared_frame_ring():
+    ring = SharedFrameRing.create((3, 4), dtype=np.uint16, nslots=4)
+    try:
+        consumer = SharedFrameRing.attach(ring.name)
+        assert consumer.shape == (3, 4) and consumer.dtype == np.uint16
+        assert consumer.get(0) is None
+        frames = np.arange(6*12, dtype=np.uint16).reshape(6, 3, 4)
+        for n in range(4):
+            ring.put(n, frames[n])
+        out = np.empty((3, 4), dtype=np.uint16)
+        assert consumer.get(2, out=out) is out
+        assert np.array_equal(out, frames[2])
+        assert np.array_equal(consumer.wait(3, timeout=1), frames[3])
+        # frames 4 and 5 recycle the slots of frames 0 and 1
+        ring.put(4, frames[4])
+        ring.put(5, frames[5])
+        assert consumer.get(0) is None
+        assert consumer.wait(1, timeout=1) is None
+        assert np.array_equal(consumer.get(5), frames[5])
+        assert np.array_equal(consumer.get(2), frames[2])
+        # not published yet
+        assert consumer.wait(6, timeout=.01) is None
+        # a slot being written is not read
+        ring._slot_frames[2] = -1
+        assert consumer.get(2) is None
+        with pytest.raises(RuntimeError):
+            consumer.unlink()
+        consumer.close()
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+class RecordingBackend(MmapBackend):
+    ''' Count the bytes read through the backend.'''
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.nread = 0
+
+    def __getitem__(self, s):
+        data = super().__getitem__(s)
+        self.nread += len(data)
+        return data
+
+
+def test_bnl_tiled(tmp_path):
+    frames = make_frames(nframes=5, rows=64, cols=96)
+    nframes, rows, cols = frames.shape
+    filename = str(tmp_path / "tiled.bin")
+    header = pack_bnl_header(dict(nrows=rows, ncols=cols), magic=BNL_MAGIC_V3)
+    write_bnl(filename, frames, header=header, encoding='tiled',
+              tile_shape=(16, 32))
+
+    mf = MultifileBNL(filename, backend=RecordingBackend)
+    assert mf.tile_shape == (16, 32)
+    for n, frame in enumerate(frames):
+        assert np.array_equal(mf.rdframe(n), frame)
+        pos, vals = mf.rdrawframe(n)
+        assert np.array_equal(pos, np.flatnonzero(frame))
+
+    roi = (20, 30, 40, 60)
+    full = mf._record_at(2)[3]
+    mf._fd.nread = 0
+    assert np.array_equal(mf.rdframe(2, roi=roi),
+                          frames[2, 20:30, 40:60])
+    # one of the 12 tiles, and the tile table
+    assert mf._fd.nread < full/4
+
+
+def test_bnl_update_index(tmp_path):
+    frames = make_frames(nframes=20)
+    nframes, rows, cols = frames.shape
+    filename = str(tmp_path / "live.bin")
+    for codec in [None, 'zlib']:
+        header = pack_bnl_header(dict(nrows=rows, ncols=cols),
+                                 magic=BNL_MAGIC_V3)
+        fout = MultifileBNLWriter(filename, header, codec=codec,
+                                  block_frames=4)
+        for n, frame in enumerate(frames):
+            w = np.flatnonzero(frame)
+            fout.write_frame(w, frame.ravel()[w])
+            if n in [5, 13]:
+                fout.update_index()
+                mf = MultifileBNL(filename)
+                # only the complete blocks of a block file
+                assert len(mf) == (n + 1 if codec is None else n//4*4)
+                assert mf._read_footer()
+                assert np.array_equal(mf.rdframe(len(mf) - 1),
+                                      frames[len(mf) - 1])
+                mf.close()
+        fout.close()
+        mf = MultifileBNL(filename)
+        assert mf._read_footer()
+        assert np.array_equal(mf.rdframes(range(nframes)), frames)
+
+
+def test_compress_stream(tmp_path):
+    frames = make_frames(nframes=25)
+    nframes, rows, cols = frames.shape
+    filename = str(tmp_path / "stream.bin")
+    stack = str(tmp_path / "frames.npy")
+    np.save(stack, frames)
+    mask = np.ones((rows, cols))
+    mask[:, 3] = 0
+
+    sources = [frames, np.load(stack, mmap_mode='r'),
+               (frame for frame in frames),
+               (batch for batch in np.array_split(frames, 4))]
+    for source in sources:
+        for kwargs in [dict(), dict(bnl_version=3, encoding='auto'),
+                       dict(codec='zlib', compact=True, bnl_version=3)]:
+            n = compress_stream(source, dict(frame_time=.1), filename,
+                                mask=mask, block_size=7, **kwargs)
+            assert n == nframes
+            mf = open_multifile(filename)
+            assert mf.md['frame_time'] == .1
+            assert mf.nbytes == 2
+            assert np.array_equal(mf.rdframes(range(nframes)), frames*mask)
+            if not isinstance(source, np.ndarray):
+                break
+    # the input is not changed
+    assert np.array_equal(np.load(stack), frames)